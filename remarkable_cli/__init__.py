@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
-from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from argparse import SUPPRESS, ArgumentParser, ArgumentDefaultsHelpFormatter
 from os import path
+
+from paramiko.common import DEFAULT_MAX_PACKET_SIZE, DEFAULT_WINDOW_SIZE
+
 from .client import Client
+from .fleet import Fleet
 
 name = "remarkable-cli"
 __version__ = "0.3.2"
 __all__ = ["main"]
 
 
-def main():
+def build_parser():
     parser = ArgumentParser(
         "remarkable-cli",
         description="A CLI for interacting with the Remarkable paper tablet.",
@@ -32,7 +36,17 @@ def main():
         help="backup actions to perform on reMarkable tablet",
         action="append",
         type=str,
-        choices=["push", "pull", "pull-raw", "pull-web", "convert-raw", "clean-local"],
+        choices=[
+            "push",
+            "pull",
+            "pull-raw",
+            "pull-web",
+            "convert-raw",
+            "clean-local",
+            "ls",
+            "find",
+            "stat",
+        ],
     )
 
     device_group = parser.add_argument_group("reMarkable device")
@@ -63,6 +77,47 @@ def main():
         type=str,
         default=None
     )
+    device_group.add_argument(
+        "--agent",
+        help="share one ssh connection across invocations through a local agent",
+        action="store_true",
+    )
+    device_group.add_argument(
+        "--agent-idle-timeout",
+        help="seconds of inactivity before the local agent exits",
+        type=float,
+        default=300.0,
+    )
+    device_group.add_argument("--agent-serve", action="store_true", help=SUPPRESS)
+    device_group.add_argument(
+        "--compress",
+        help="compress the ssh transport, faster over slow wi-fi links",
+        action="store_true",
+    )
+    device_group.add_argument(
+        "--ciphers",
+        help="comma separated ssh ciphers to negotiate, e.g. aes128-ctr",
+        type=str,
+        default=None,
+    )
+    device_group.add_argument(
+        "--window-size",
+        help="ssh channel window size in bytes",
+        type=int,
+        default=DEFAULT_WINDOW_SIZE,
+    )
+    device_group.add_argument(
+        "--max-packet-size",
+        help="ssh channel maximum packet size in bytes",
+        type=int,
+        default=DEFAULT_MAX_PACKET_SIZE,
+    )
+    device_group.add_argument(
+        "--auto-tune",
+        help="probe and pick the fastest compression, cipher and channel sizes "
+        + "for the destination, the choice is cached for a week",
+        action="store_true",
+    )
     device_group.add_argument(
         "-f",
         "--file-path",
@@ -86,13 +141,102 @@ def main():
         type=str,
         default=path.join(path.expanduser("~"), "reMarkable"),
     )
+    local_group.add_argument(
+        "-i",
+        "--push-path",
+        help="push: local pdf or epub file, or directory of files, to upload",
+        metavar="PATH",
+        action="append",
+        type=str,
+        default=None,
+    )
+    local_group.add_argument(
+        "-j",
+        "--jobs",
+        help="number of worker processes rendering documents in parallel",
+        type=int,
+        default=1,
+    )
+    local_group.add_argument(
+        "--format",
+        help="pull, convert-raw: render pdf documents, or export the strokes of "
+        + "each document as columnar arrays (columnar/<uuid>/*.npy, needs numpy)",
+        choices=["pdf", "columnar"],
+        type=str,
+        default="pdf",
+    )
+    local_group.add_argument(
+        "--pipeline",
+        help="pull: render each document as soon as its files are pulled",
+        action="store_true",
+    )
+
+    index_group = parser.add_argument_group(
+        "index", "offline queries (ls, find, stat) answered from the local backup"
+    )
+    index_group.add_argument(
+        "-q",
+        "--query",
+        help="ls: folder path, find: glob on the name or path, stat: path or uuid",
+        type=str,
+        default=None,
+    )
+
+    fleet_group = parser.add_argument_group("fleet")
+    fleet_group.add_argument(
+        "--devices",
+        help="INI config file with one section per device, run all concurrently",
+        metavar="CONFIG",
+        type=str,
+        default=None,
+    )
+    fleet_group.add_argument(
+        "--max-transfers",
+        help="maximum concurrent file transfers across all devices",
+        type=int,
+        default=4,
+    )
+
+    selection_group = parser.add_argument_group(
+        "selection",
+        "glob patterns on the visible path (default), or prefixed with "
+        + "name:, uuid: or type: (notebook, pdf, epub, folder)",
+    )
+    selection_group.add_argument(
+        "--include",
+        help="only pull and convert entities matching the pattern",
+        metavar="PATTERN",
+        action="append",
+        type=str,
+        default=None,
+    )
+    selection_group.add_argument(
+        "--exclude",
+        help="do not pull or convert entities matching the pattern",
+        metavar="PATTERN",
+        action="append",
+        type=str,
+        default=None,
+    )
+    return parser
+
 
+def main():
+    parser = build_parser()
     args = parser.parse_args()
 
+    if args.agent_serve:
+        Client(args).serve_agent()
+        return
+
     if not args.action:
         # no action specified, display the help message
         parser.print_help()
         return
 
+    if args.devices:
+        Fleet(args, parser).run()
+        return
+
     c = Client(args)
     c.run_actions()
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""Persistent SSH connection agent, shared across CLI invocations.
+
+The agent process holds a connected paramiko.SSHClient and serves the remote
+operations used by the Client (listdir, stat, read, exec) over a Unix socket.
+Messages are a 4 byte big-endian header length, a JSON header, and optionally
+a raw payload whose length is given by the header.
+"""
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from socketserver import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+from struct import calcsize, pack, unpack
+
+import paramiko
+
+HEADER_FMT = ">I"
+READ_CHUNK_SIZE = 1 << 20
+SFTP_ATTRS = ("st_mode", "st_size", "st_mtime", "st_atime", "st_uid", "st_gid")
+
+
+def _send(fh, header: dict, payload: bytes = b""):
+    raw_header = json.dumps(header).encode("utf-8")
+    fh.write(pack(HEADER_FMT, len(raw_header)) + raw_header)
+    if payload:
+        fh.write(payload)
+    fh.flush()
+
+
+def _recv_exact(fh, size: int):
+    data = fh.read(size)
+    if len(data) != size:
+        raise ConnectionError("agent connection closed")
+    return data
+
+
+def _recv(fh):
+    (header_size,) = unpack(HEADER_FMT, _recv_exact(fh, calcsize(HEADER_FMT)))
+    return json.loads(_recv_exact(fh, header_size).decode("utf-8"))
+
+
+def _attr_to_dict(attr: paramiko.SFTPAttributes):
+    values = {key: getattr(attr, key, None) for key in SFTP_ATTRS}
+    values["filename"] = getattr(attr, "filename", None)
+    return values
+
+
+def _attr_from_dict(values: dict):
+    attr = paramiko.SFTPAttributes()
+    for key, value in values.items():
+        if value is not None:
+            setattr(attr, key, value)
+    return attr
+
+
+def run_command(ssh_client: paramiko.SSHClient, command: str, stdin_writer=None):
+    """Run the command on the remote, returning (exit status, stdout, stderr).
+    If provided, stdin_writer is called with the writable remote stdin file.
+    """
+    channel = ssh_client.get_transport().open_session()
+    try:
+        channel.exec_command(command)
+        if stdin_writer is not None:
+            with channel.makefile_stdin("wb") as stdin:
+                stdin_writer(stdin)
+        channel.shutdown_write()
+        stdout = channel.makefile("rb").read()
+        stderr = channel.makefile_stderr("rb").read()
+        return channel.recv_exit_status(), stdout, stderr
+    finally:
+        channel.close()
+
+
+class _AgentRequestHandler(StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.server.track_connection(1)
+        self._sftp = None
+        self._remote_fh = None
+        self._remote_path = None
+
+    def finish(self):
+        if self._remote_fh is not None:
+            self._remote_fh.close()
+        if self._sftp is not None:
+            self._sftp.close()
+        self.server.track_connection(-1)
+        super().finish()
+
+    @property
+    def sftp(self):
+        if self._sftp is None:
+            self._sftp = self.server.ssh_client.open_sftp()
+        return self._sftp
+
+    def _open_remote(self, path: str, offset: int):
+        # keep the last read file open, as files are read in sequential chunks
+        if self._remote_path != path:
+            if self._remote_fh is not None:
+                self._remote_fh.close()
+                self._remote_fh = None
+            self._remote_fh = self.sftp.open(path, "rb")
+            self._remote_path = path
+            # pipeline the sftp reads of the rest of the file, rather than one
+            # round trip per 32 KiB block of each chunk
+            self._remote_fh.seek(offset)
+            self._remote_fh.prefetch()
+        elif self._remote_fh.tell() != offset:
+            self._remote_fh.seek(offset)
+        return self._remote_fh
+
+    def handle(self):
+        while True:
+            try:
+                request = _recv(self.rfile)
+            except (ConnectionError, OSError, ValueError):
+                return
+            self.server.touch()
+
+            op = request.get("op")
+            try:
+                if op == "listdir_attr":
+                    entries = self.sftp.listdir_attr(request["path"])
+                    _send(
+                        self.wfile,
+                        {"ok": True, "entries": [_attr_to_dict(e) for e in entries]},
+                    )
+                elif op == "stat":
+                    attr = self.sftp.stat(request["path"])
+                    _send(self.wfile, {"ok": True, "attr": _attr_to_dict(attr)})
+                elif op == "read":
+                    remote_fh = self._open_remote(
+                        request["path"], request.get("offset", 0)
+                    )
+                    data = remote_fh.read(request["size"])
+                    _send(self.wfile, {"ok": True, "size": len(data)}, data)
+                elif op == "exec":
+                    self._handle_exec(request)
+                else:
+                    _send(self.wfile, {"ok": False, "error": f"unknown op: {op}"})
+            except (ConnectionError, BrokenPipeError):
+                return
+            except Exception as e:
+                self._remote_path = None
+                _send(
+                    self.wfile,
+                    {"ok": False, "error": str(e), "errno": getattr(e, "errno", None)},
+                )
+            self.server.touch()
+
+    def _handle_exec(self, request):
+        def read_stdin(stdin):
+            # stdin is streamed as framed chunks, terminated by an empty chunk
+            while True:
+                chunk_size = _recv(self.rfile)["size"]
+                if not chunk_size:
+                    break
+                stdin.write(_recv_exact(self.rfile, chunk_size))
+
+        stdin_writer = read_stdin if request.get("stdin") else None
+        exit_status, stdout, stderr = run_command(
+            self.server.ssh_client, request["command"], stdin_writer=stdin_writer
+        )
+        _send(
+            self.wfile,
+            {
+                "ok": True,
+                "exit_status": exit_status,
+                "stdout_size": len(stdout),
+                "stderr_size": len(stderr),
+            },
+            stdout + stderr,
+        )
+
+
+class Agent(ThreadingMixIn, UnixStreamServer):
+    """Serve the SSH connection over a Unix socket until idle for idle_timeout.
+    Only one agent serves a socket path, held with a lock file next to it. Raises
+    FileExistsError if another agent holds the lock.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        ssh_client: paramiko.SSHClient,
+        socket_path: str,
+        idle_timeout: float = 300.0,
+        logger: logging.Logger = None,
+    ):
+        self._log = logger or logging.getLogger(__name__)
+        self.ssh_client = ssh_client
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.timeout = 1.0
+
+        self._lock = threading.Lock()
+        self._connections = 0
+        self._last_activity = time.monotonic()
+
+        # agents started by concurrent invocations must not unlink a live socket
+        self._lock_fh = open(f"{socket_path}{os.extsep}lock", "w")
+        try:
+            fcntl.flock(self._lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_fh.close()
+            raise FileExistsError(errno.EEXIST, "agent already running", socket_path)
+        try:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            super().__init__(socket_path, _AgentRequestHandler)
+            os.chmod(socket_path, 0o600)
+        except Exception:
+            self._lock_fh.close()
+            raise
+
+    def track_connection(self, delta: int):
+        with self._lock:
+            self._connections += delta
+            self._last_activity = time.monotonic()
+
+    def touch(self):
+        with self._lock:
+            self._last_activity = time.monotonic()
+
+    def _is_idle(self):
+        with self._lock:
+            idle_time = time.monotonic() - self._last_activity
+            return self._connections == 0 and idle_time >= self.idle_timeout
+
+    def serve_until_idle(self):
+        self._log.info("agent listening on %s", self.socket_path)
+        try:
+            while not self._is_idle():
+                transport = self.ssh_client.get_transport()
+                if transport is None or not transport.is_active():
+                    self._log.warning("agent ssh transport closed")
+                    break
+                self.handle_request()
+        finally:
+            self.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self._lock_fh.close()
+        self._log.info("agent stopped")
+
+
+class _AgentFile:
+    """Read only remote file, mirroring the used subset of paramiko.SFTPFile"""
+
+    def __init__(self, connection, path: str):
+        self._connection = connection
+        self._path = path
+        self._offset = 0
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET):
+        if whence != os.SEEK_SET:
+            raise ValueError("agent files only support absolute seek")
+        self._offset = offset
+
+    def tell(self):
+        return self._offset
+
+    def read(self, size: int = READ_CHUNK_SIZE):
+        _, data = self._connection.request(
+            {"op": "read", "path": self._path, "offset": self._offset, "size": size}
+        )
+        self._offset += len(data)
+        return data
+
+    def prefetch(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AgentSFTPClient:
+    """Mirrors the used subset of paramiko.SFTPClient over the agent socket"""
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def listdir_attr(self, path="."):
+        response, _ = self._connection.request({"op": "listdir_attr", "path": path})
+        entries = []
+        for values in response["entries"]:
+            entries.append(_attr_from_dict(values))
+        return entries
+
+    def stat(self, path):
+        response, _ = self._connection.request({"op": "stat", "path": path})
+        return _attr_from_dict(response["attr"])
+
+    def open(self, filename, mode="r"):
+        if set(mode) - set("rb"):
+            raise IOError(f"agent files are read only, unsupported mode {mode}")
+        return _AgentFile(self._connection, filename)
+
+    def get(self, remotepath, localpath):
+        with self.open(remotepath, "rb") as remote_fh, open(localpath, "wb") as fh:
+            while True:
+                data = remote_fh.read(READ_CHUNK_SIZE)
+                fh.write(data)
+                if len(data) < READ_CHUNK_SIZE:
+                    break
+
+    def close(self):
+        pass
+
+
+class AgentConnection:
+    """Mirrors the used subset of paramiko.SSHClient over the agent socket"""
+
+    def __init__(self, socket_path: str, timeout: float = 30.0):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(socket_path)
+        self._sock.settimeout(None)
+        self._rfile = self._sock.makefile("rb")
+        self._wfile = self._sock.makefile("wb")
+        self._lock = threading.Lock()
+
+    def _read_response(self):
+        response = _recv(self._rfile)
+        if not response.get("ok"):
+            if response.get("errno") is not None:
+                raise OSError(response["errno"], response.get("error"))
+            raise RuntimeError(f"agent error: {response.get('error')}")
+        payload = b""
+        size = response.get("size", 0) + response.get("stdout_size", 0)
+        size += response.get("stderr_size", 0)
+        if size:
+            payload = _recv_exact(self._rfile, size)
+        return response, payload
+
+    def request(self, header: dict):
+        with self._lock:
+            _send(self._wfile, header)
+            return self._read_response()
+
+    def open_sftp(self):
+        return AgentSFTPClient(self)
+
+    def exec_command(self, command: str, stdin_writer=None):
+        """Run the command through the agent, see run_command"""
+        with self._lock:
+            _send(
+                self._wfile,
+                {"op": "exec", "command": command, "stdin": stdin_writer is not None},
+            )
+            if stdin_writer is not None:
+                stdin_writer(_AgentStdin(self._wfile))
+                _send(self._wfile, {"size": 0})
+            response, payload = self._read_response()
+        stdout_size = response["stdout_size"]
+        return response["exit_status"], payload[:stdout_size], payload[stdout_size:]
+
+    def close(self):
+        for fh in (self._rfile, self._wfile):
+            fh.close()
+        self._sock.close()
+
+
+class _AgentStdin:
+    """Writable file, framing the written data for the agent exec stdin"""
+
+    def __init__(self, wfile):
+        self._wfile = wfile
+
+    def write(self, data):
+        if data:
+            _send(self._wfile, {"size": len(data)}, bytes(data))
+        return len(data)
+
+    def flush(self):
+        self._wfile.flush()
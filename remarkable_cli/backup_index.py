@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+
+
+class BackupIndex:
+    """SQLite index of the xochitl entities in the local backup, for answering
+    ls, find and stat queries without the tablet or re-parsing the JSON files.
+
+    Entity paths are the visible folder paths, trashed entities are under trash/.
+    The index also tracks the rendered outputs of each entity with a fingerprint of
+    the inputs they were rendered from, kept across entity rebuilds.
+    """
+
+    SCHEMA_VERSION = 2
+    SCHEMA = (
+        """CREATE TABLE entities (
+            uuid TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            path TEXT NOT NULL,
+            parent TEXT NOT NULL,
+            type TEXT NOT NULL,
+            page_count INTEGER,
+            last_modified INTEGER NOT NULL
+        )""",
+        "CREATE INDEX entities_path ON entities (path)",
+        "CREATE INDEX entities_parent ON entities (parent)",
+        """CREATE TABLE templates (
+            uuid TEXT NOT NULL REFERENCES entities (uuid),
+            page INTEGER NOT NULL,
+            template TEXT NOT NULL,
+            PRIMARY KEY (uuid, page)
+        )""",
+        """CREATE TABLE outputs (
+            uuid TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            path TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            PRIMARY KEY (uuid, kind)
+        )""",
+    )
+    COLUMNS = ("uuid", "name", "path", "parent", "type", "page_count", "last_modified")
+
+    def __init__(self, db_fp: str):
+        self.db_fp = db_fp
+        self._conn = sqlite3.connect(db_fp)
+        self._conn.row_factory = sqlite3.Row
+
+        (version,) = self._conn.execute("PRAGMA user_version").fetchone()
+        # True if the index was just created, and has no entities yet
+        self.created = version != BackupIndex.SCHEMA_VERSION
+        if self.created:
+            # the index is derived data, rebuild from scratch on schema changes
+            with self._conn:
+                self._conn.execute("DROP TABLE IF EXISTS outputs")
+                self._conn.execute("DROP TABLE IF EXISTS templates")
+                self._conn.execute("DROP TABLE IF EXISTS entities")
+                for statement in BackupIndex.SCHEMA:
+                    self._conn.execute(statement)
+                self._conn.execute(
+                    f"PRAGMA user_version = {BackupIndex.SCHEMA_VERSION}"
+                )
+
+    def close(self):
+        self._conn.close()
+
+    def replace_entities(self, entities):
+        """Replace the index contents in a single transaction.
+        entities is an iterable of dicts with the COLUMNS keys and a templates key,
+        listing the template name of every page.
+        """
+        columns = ", ".join(BackupIndex.COLUMNS)
+        placeholders = ", ".join("?" for _ in BackupIndex.COLUMNS)
+        count = 0
+        with self._conn:
+            self._conn.execute("DELETE FROM templates")
+            self._conn.execute("DELETE FROM entities")
+            for entity in entities:
+                self._conn.execute(
+                    f"INSERT INTO entities ({columns}) VALUES ({placeholders})",
+                    [entity[column] for column in BackupIndex.COLUMNS],
+                )
+                self._conn.executemany(
+                    "INSERT INTO templates (uuid, page, template) VALUES (?, ?, ?)",
+                    [
+                        (entity["uuid"], page, template)
+                        for page, template in enumerate(entity.get("templates", ()))
+                    ],
+                )
+                count += 1
+        return count
+
+    def lookup(self, query: str):
+        """Get the entity with the uuid or path, or None"""
+        return self._conn.execute(
+            "SELECT * FROM entities WHERE uuid = ? OR path = ? ORDER BY uuid = ? DESC",
+            (query, query.strip(os.sep), query),
+        ).fetchone()
+
+    def list_folder(self, path: str = ""):
+        """Get the entities directly within the folder path, or None if there is no
+        such folder. The empty path is the root folder, trash the trash folder.
+        """
+        path = path.strip(os.sep)
+        if path in ("", "trash"):
+            parent = path
+        else:
+            folder = self.lookup(path)
+            if folder is None or folder["type"] != "folder":
+                return None
+            parent = folder["uuid"]
+        return self._conn.execute(
+            "SELECT * FROM entities WHERE parent = ? "
+            + "ORDER BY type != 'folder', name COLLATE NOCASE",
+            (parent,),
+        ).fetchall()
+
+    def find(self, pattern: str):
+        """Get the entities with a name or path matching the glob pattern"""
+        return self._conn.execute(
+            "SELECT * FROM entities WHERE name GLOB ? OR path GLOB ? ORDER BY path",
+            (pattern, pattern.strip(os.sep)),
+        ).fetchall()
+
+    def templates(self, uuid: str):
+        """Get (template, page count) pairs of the entity, most used first"""
+        return self._conn.execute(
+            "SELECT template, COUNT(*) FROM templates WHERE uuid = ? "
+            + "GROUP BY template ORDER BY COUNT(*) DESC, template",
+            (uuid,),
+        ).fetchall()
+
+    def tracked_output(self, uuid: str, kind: str):
+        """Get the (path, fingerprint) row of the entity output, or None"""
+        return self._conn.execute(
+            "SELECT path, fingerprint FROM outputs WHERE uuid = ? AND kind = ?",
+            (uuid, kind),
+        ).fetchone()
+
+    def tracked_outputs(self, kind: str):
+        """Get the (uuid, path, fingerprint) rows of all outputs of the kind"""
+        return self._conn.execute(
+            "SELECT uuid, path, fingerprint FROM outputs WHERE kind = ?", (kind,)
+        ).fetchall()
+
+    def track_output(self, uuid: str, kind: str, path: str, fingerprint: str):
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO outputs (uuid, kind, path, fingerprint) "
+                + "VALUES (?, ?, ?, ?)",
+                (uuid, kind, path, fingerprint),
+            )
+
+    def untrack_output(self, uuid: str, kind: str):
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM outputs WHERE uuid = ? AND kind = ?", (uuid, kind)
+            )
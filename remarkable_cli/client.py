@@ -1,23 +1,84 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
+import subprocess
+import sys
+import tarfile
+import time
 from argparse import Namespace
-from collections import deque
-from glob import glob
+from collections import Counter, deque
+from concurrent.futures import Executor, ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from glob import escape, glob
+from io import BytesIO
+from shlex import quote
 from shutil import rmtree
 from stat import S_ISDIR, S_ISREG
+from tempfile import gettempdir
+from uuid import uuid4
 
-import paramiko
+from pypdf import PdfWriter
 from requests import Request, Session, adapters
 
+from .agent import Agent, AgentConnection, run_command
+from .backup_index import BackupIndex
+from .columnar import export_columnar
 from .convert_rm import ConvertRM
+from .entity_filter import EntityFilter
+from .ssh_tuning import (
+    CIPHER_CANDIDATES,
+    MAX_PACKET_SIZE_CANDIDATES,
+    WINDOW_SIZE_CANDIDATES,
+    TuningCache,
+    connect_ssh,
+    parse_ciphers,
+    supported_ciphers,
+)
+
+
+def _render_document(
+    uuid_fp, templates_dir, path, last_modified, output_format="pdf", page_executor=None
+):
+    """Render the raw xochitl entity into a PDF, or export its strokes as columnar
+    arrays, runs in a worker process. With a page_executor, runs in the calling
+    process and renders the pages in the executor workers instead.
+    """
+    converter = ConvertRM(uuid_fp, templates_dir, logger=logging.getLogger(__name__))
+    if output_format == "columnar":
+        export_columnar(converter, path)
+    else:
+        converter.convert_document(path, executor=page_executor)
+    os.utime(path, (last_modified, last_modified))
 
 
 class Client:
     LOG_LEVELS = ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"]
+    TRANSFER_CHUNK_SIZE = 1 << 20
+    # partial transfers of files at least this large are resumed
+    RESUME_MIN_SIZE = 1 << 20
+    PUSH_FILE_TYPES = ("pdf", "epub")
+    # original documents the xochitl pages are rendered from
+    SOURCE_FILE_TYPES = ("pdf", "epub")
+    # documents with at least this many pages render page by page in the pool
+    PAGE_PARALLEL_MIN_PAGES = 16
+    # bytes of xochitl files read by each auto-tune probe transfer
+    PROBE_SIZE = 1 << 20
 
-    def __init__(self, args: Namespace):
+    def __init__(
+        self,
+        args: Namespace,
+        logger: logging.Logger = None,
+        render_executor: Executor = None,
+        transfer_slots=None,
+    ):
+        """
+        render_executor and transfer_slots (a semaphore) are optional, to share
+        the render workers and limit concurrent transfers across many clients.
+        """
         log_format = "%(asctime)s [%(levelname)s]: %(message)s"
         if args.log_level is None:
             args.log_level = 3
@@ -25,10 +86,15 @@ class Client:
         log_level = Client.LOG_LEVELS[log_index]
         logging.basicConfig(format=log_format, level=logging.getLevelName(log_level))
 
-        self._log = logging.getLogger(__name__)
+        self._log = logger or logging.getLogger(__name__)
         self.args = args
         self._log.debug(args)
         self.ssh_client = None
+        self.render_executor = render_executor
+        self.transfer_slots = transfer_slots or nullcontext()
+        self.stats = Counter()
+        # ids of the entities on the tablet, listed when pulling
+        self.remote_entity_ids = None
 
         # create the backup directory if not exists
         os.makedirs(self.args.backup_dir, exist_ok=True)
@@ -37,12 +103,23 @@ class Client:
         self.templates_dir = os.path.join(self.args.backup_dir, "templates")
         self.pdf_backup_dir = os.path.join(self.args.backup_dir, "My files")
         self.trash_backup_dir = os.path.join(self.args.backup_dir, "Trash")
+        self.columnar_dir = os.path.join(self.args.backup_dir, "columnar")
+        self.index_fp = os.path.join(self.args.backup_dir, ".index.sqlite3")
+
+        self.entity_filter = EntityFilter(args.include or (), args.exclude or ())
 
     @staticmethod
-    def sftp_walk(ftp_client, remote_path, sub_dirs=()):
-        """Walk through the remote reMarkable directory structure"""
-        for file_attr in ftp_client.listdir_attr(os.path.join(remote_path, *sub_dirs)):
-            if S_ISDIR(file_attr.st_mode):
+    def sftp_walk(ftp_client, remote_path, sub_dirs=(), select=None):
+        """Walk through the remote reMarkable directory structure.
+        If provided, select is called with each top level file or directory name,
+        entries it returns False for are not walked.
+        Entries are walked in name order, keeping the files of an entity together.
+        """
+        file_attrs = ftp_client.listdir_attr(os.path.join(remote_path, *sub_dirs))
+        for file_attr in sorted(file_attrs, key=lambda attr: attr.filename):
+            if not sub_dirs and select is not None and not select(file_attr.filename):
+                continue
+            elif S_ISDIR(file_attr.st_mode):
                 # directory, recurse into the folder
                 nested_sub_dirs = list(sub_dirs)
                 nested_sub_dirs.append(file_attr.filename)
@@ -92,21 +169,29 @@ class Client:
 
             if action == "push":
                 self.connect()
-                self._log.warning("not implemented")
+                self.push_files()
+            elif action == "pull" and self.args.pipeline:
+                self.connect()
+                self.pull_pipelined()
+                self.update_index()
             elif action == "pull":
                 self.connect()
                 self.pull_template_files()
                 self.pull_xochitl_files()
+                self.update_index()
                 self.convert_xochitl_files()
             elif action == "pull-raw":
                 self.connect()
                 self.pull_xochitl_files()
+                self.update_index()
             elif action == "pull-web":
                 self.pull_pdf_files()
             elif action == "convert-raw":
                 self.convert_xochitl_files()
             elif action == "clean-local":
                 self.clean_local()
+            elif action in ("ls", "find", "stat"):
+                self.query_index(action)
             else:
                 self._log.warning("unknown action: %s", action)
 
@@ -115,30 +200,248 @@ class Client:
 
     def connect(self):
         """Connect to the reMarkable tablet using Paramiko SSH"""
+        if self.ssh_client is None and self.args.agent:
+            self.ssh_client = self._connect_agent()
+
         if self.ssh_client is None:
             username = self.args.username
             hostname = self.args.destination
             port = self.args.port
-            password = self.args.password
             self._log.info("Connecting to %s@%s:%d", username, hostname, port)
 
+            transport_options = {
+                "compress": self.args.compress,
+                "ciphers": parse_ciphers(self.args.ciphers),
+            }
+            if self.args.auto_tune:
+                transport_options.update(self._auto_tune() or {})
+
             try:
-                ssh_client = paramiko.SSHClient()
-                ssh_client.load_system_host_keys()
-                ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh_client.connect(
-                    hostname=hostname,
-                    username=username,
-                    port=port,
-                    password=password,
-                    timeout=5.0,
-                )
-                self.ssh_client = ssh_client
+                self.ssh_client = self._connect_ssh(**transport_options)
             except Exception:
                 self._log.error("could not connect to reMarkable tablet")
                 raise
         return self.ssh_client
 
+    def _connect_ssh(
+        self, compress=False, ciphers=None, window_size=None, max_packet_size=None
+    ):
+        return connect_ssh(
+            self.args.destination,
+            self.args.port,
+            self.args.username,
+            self.args.password,
+            compress=compress,
+            ciphers=ciphers,
+            window_size=window_size or self.args.window_size,
+            max_packet_size=max_packet_size or self.args.max_packet_size,
+        )
+
+    def _probe_transfer(self, ssh_client, probe_files):
+        """Read the probe files over sftp, returning the elapsed seconds"""
+        ftp_client = ssh_client.open_sftp()
+        try:
+            start = time.monotonic()
+            for remote_fp in probe_files:
+                with ftp_client.open(remote_fp, "rb") as remote_fh:
+                    remote_fh.prefetch()
+                    while remote_fh.read(Client.TRANSFER_CHUNK_SIZE):
+                        pass
+            return time.monotonic() - start
+        finally:
+            ftp_client.close()
+
+    def _probe_files(self, ssh_client):
+        """Pick xochitl files adding up to about PROBE_SIZE bytes"""
+        ftp_client = ssh_client.open_sftp()
+        probe_files, probe_size = [], 0
+        try:
+            for file_attr, rel_fp in Client.sftp_walk(ftp_client, self.args.file_path):
+                if probe_size >= Client.PROBE_SIZE:
+                    break
+                probe_files.append(os.path.join(self.args.file_path, rel_fp))
+                probe_size += file_attr.st_size
+        finally:
+            ftp_client.close()
+        return probe_files
+
+    def _time_probe(self, probe_files, transport_options):
+        """Time the probe transfer with the transport options, None if it failed"""
+        try:
+            ssh_client = self._connect_ssh(**transport_options)
+        except Exception:
+            self._log.debug("cannot connect with %s", transport_options, exc_info=True)
+            return None
+        try:
+            # untimed first pass, warming the tablet page cache and channel
+            self._probe_transfer(ssh_client, probe_files)
+            elapsed = self._probe_transfer(ssh_client, probe_files)
+        except Exception:
+            self._log.debug("probe failed with %s", transport_options, exc_info=True)
+            return None
+        finally:
+            ssh_client.close()
+        self._log.debug("%s: %.3fs", transport_options, elapsed)
+        return elapsed
+
+    def _auto_tune(self):
+        """Get the fastest compression, cipher and channel sizes for the destination.
+        Every compression and cipher combination is timed on a short probe transfer
+        of xochitl files, then the channel window and packet sizes with the fastest.
+        The choice is cached per destination. Returns None if no probe succeeded.
+        """
+        destination = f"{self.args.username}@{self.args.destination}:{self.args.port}"
+        cache = TuningCache(TuningCache.default_path())
+        settings = cache.get(destination)
+        if settings is not None:
+            self._log.debug("cached transport settings %s", settings)
+            return settings
+
+        self._log.info("probing transport settings for %s", destination)
+        try:
+            ssh_client = self._connect_ssh(
+                compress=self.args.compress, ciphers=parse_ciphers(self.args.ciphers)
+            )
+            try:
+                probe_files = self._probe_files(ssh_client)
+            finally:
+                ssh_client.close()
+        except Exception:
+            self._log.debug("cannot list the probe files", exc_info=True)
+            probe_files = None
+        if not probe_files:
+            # timing an empty transfer would cache an arbitrary choice
+            self._log.warning("nothing to probe, using the given transport settings")
+            return None
+
+        results = []
+        ciphers = [c for c in CIPHER_CANDIDATES if c in supported_ciphers()]
+        for compress in (False, True):
+            for cipher in ciphers:
+                options = {"compress": compress, "ciphers": [cipher]}
+                elapsed = self._time_probe(probe_files, options)
+                if elapsed is not None:
+                    results.append((elapsed, options))
+        if not results:
+            self._log.warning("transport probe failed, using the given settings")
+            return None
+
+        _, fastest = min(results, key=lambda result: result[0])
+        for window_size in WINDOW_SIZE_CANDIDATES:
+            for max_packet_size in MAX_PACKET_SIZE_CANDIDATES:
+                options = dict(
+                    fastest, window_size=window_size, max_packet_size=max_packet_size
+                )
+                elapsed = self._time_probe(probe_files, options)
+                if elapsed is not None:
+                    results.append((elapsed, options))
+
+        _, settings = min(results, key=lambda result: result[0])
+        self._log.info("tuned transport: %s", settings)
+        cache.put(destination, settings)
+        return settings
+
+    def _agent_socket_path(self):
+        agent_dir = os.path.join(gettempdir(), f"remarkable-cli-{os.getuid()}")
+        os.makedirs(agent_dir, mode=0o700, exist_ok=True)
+        return os.path.join(
+            agent_dir,
+            f"{self.args.username}@{self.args.destination}:{self.args.port}.sock",
+        )
+
+    def _spawn_agent(self):
+        """Start the agent as a detached process, password is passed on stdin"""
+        cmd = [
+            sys.executable,
+            "-m",
+            "remarkable_cli",
+            "--agent-serve",
+            "--destination",
+            self.args.destination,
+            "--port",
+            str(self.args.port),
+            "--username",
+            self.args.username,
+            "--backup-dir",
+            self.args.backup_dir,
+            "--agent-idle-timeout",
+            str(self.args.agent_idle_timeout),
+            "--window-size",
+            str(self.args.window_size),
+            "--max-packet-size",
+            str(self.args.max_packet_size),
+        ]
+        if self.args.compress:
+            cmd.append("--compress")
+        if self.args.ciphers:
+            cmd.extend(["--ciphers", self.args.ciphers])
+        if self.args.auto_tune:
+            cmd.append("--auto-tune")
+        process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        process.stdin.write(f"{self.args.password or ''}\n".encode("utf-8"))
+        process.stdin.close()
+        return process
+
+    def _connect_agent(self, start_timeout=15.0):
+        """Connect through the local agent process, starting it if not running.
+        Returns None if the agent is unavailable, to fall back to a direct connection.
+        """
+        socket_path = self._agent_socket_path()
+        try:
+            connection = AgentConnection(socket_path)
+            self._log.info("Connected to agent %s", socket_path)
+            return connection
+        except OSError:
+            self._log.debug("agent not running at %s", socket_path)
+
+        try:
+            self._log.info("starting agent %s", socket_path)
+            process = self._spawn_agent()
+            deadline = time.monotonic() + start_timeout
+            # the agent exits cleanly if another invocation started one first
+            while time.monotonic() < deadline and process.poll() in (None, 0):
+                try:
+                    connection = AgentConnection(socket_path)
+                    self._log.info("Connected to agent %s", socket_path)
+                    return connection
+                except OSError:
+                    time.sleep(0.1)
+        except Exception:
+            self._log.debug("could not start agent", exc_info=True)
+        self._log.warning("agent unavailable, connecting directly")
+        return None
+
+    def serve_agent(self):
+        """Hold the SSH connection open, serving it to later CLI invocations"""
+        if self.args.password is None and not sys.stdin.isatty():
+            self.args.password = sys.stdin.readline().rstrip("\n") or None
+        self.args.agent = False
+        self.connect()
+        try:
+            agent = Agent(
+                self.ssh_client,
+                self._agent_socket_path(),
+                idle_timeout=self.args.agent_idle_timeout,
+                logger=self._log,
+            )
+            agent.serve_until_idle()
+        except FileExistsError:
+            self._log.info("agent already running at %s", self._agent_socket_path())
+        finally:
+            self.close()
+
+    def _exec_command(self, command, stdin_writer=None):
+        """Run the command on the tablet, returning (exit status, stdout, stderr)"""
+        if isinstance(self.ssh_client, AgentConnection):
+            return self.ssh_client.exec_command(command, stdin_writer=stdin_writer)
+        return run_command(self.ssh_client, command, stdin_writer=stdin_writer)
+
     def close(self):
         """Close the SSH session if it exists"""
         if self.ssh_client:
@@ -152,19 +455,87 @@ class Client:
             self.templates_dir,
             self.pdf_backup_dir,
             self.trash_backup_dir,
+            self.columnar_dir,
         ]
         for backup_dir in backup_dirs:
             if os.path.exists(backup_dir) and os.path.isdir(backup_dir):
                 self._log.info("removing local directory %s", backup_dir)
                 rmtree(backup_dir)
+        if os.path.isfile(self.index_fp):
+            self._log.info("removing local index %s", self.index_fp)
+            os.remove(self.index_fp)
+
+    def _pull_sftp_file(self, ftp_client, remote_fp, local_fp, pf_attr):
+        """Copy the remote file to a partial file, renamed into place when complete.
+        Interrupted transfers of large files resume from the partial file offset.
+        """
+        # the partial file is only valid for the same remote modified time
+        part_fp = f"{local_fp}{os.extsep}{int(pf_attr.st_mtime)}{os.extsep}part"
+        for stale_fp in glob(f"{escape(local_fp)}{os.extsep}*{os.extsep}part"):
+            if stale_fp != part_fp:
+                os.remove(stale_fp)
+
+        resumable = pf_attr.st_size >= Client.RESUME_MIN_SIZE
+        offset = 0
+        if resumable and os.path.isfile(part_fp):
+            offset = os.path.getsize(part_fp)
+            if offset > pf_attr.st_size:
+                offset = 0
+            elif offset:
+                self._log.info("resuming %s at byte %d", remote_fp, offset)
+
+        try:
+            with ftp_client.open(remote_fp, "rb") as remote_fh, open(
+                part_fp, "ab" if offset else "wb"
+            ) as fh:
+                remote_fh.seek(offset)
+                remote_fh.prefetch(pf_attr.st_size)
+                while offset < pf_attr.st_size:
+                    data = remote_fh.read(
+                        min(Client.TRANSFER_CHUNK_SIZE, pf_attr.st_size - offset)
+                    )
+                    if not data:
+                        break
+                    fh.write(data)
+                    offset += len(data)
+            if offset != pf_attr.st_size:
+                raise IOError(
+                    f"incomplete transfer of {remote_fp}: "
+                    + f"{offset}/{pf_attr.st_size} bytes"
+                )
+        except Exception:
+            if not resumable and os.path.isfile(part_fp):
+                os.remove(part_fp)
+            raise
+
+        os.utime(part_fp, (pf_attr.st_atime, pf_attr.st_mtime))
+        os.replace(part_fp, local_fp)
+
+    @staticmethod
+    def _entity_id(pull_file):
+        """Get the entity id from a xochitl relative file path"""
+        return pull_file.split(os.sep, 1)[0].split(os.extsep, 1)[0]
 
-    def _pull_sftp_files(self, remote_path, local_path):
+    def _pull_sftp_files(
+        self, remote_path, local_path, select=None, on_entity_pulled=None
+    ):
+        """Copy the remote files to the local path, skipping up to date files.
+        If provided, on_entity_pulled is called with each entity id once all of
+        the entity files have been pulled.
+        """
         ftp_client = None
         try:
             counter = 0
+            entity_id = None
             ftp_client = self.ssh_client.open_sftp()
-            for pf_attr, pull_file in Client.sftp_walk(ftp_client, remote_path):
+            for pf_attr, pull_file in Client.sftp_walk(
+                ftp_client, remote_path, select=select
+            ):
                 counter += 1
+                if on_entity_pulled is not None:
+                    if entity_id and entity_id != Client._entity_id(pull_file):
+                        on_entity_pulled(entity_id)
+                    entity_id = Client._entity_id(pull_file)
                 remote_fp = os.path.join(remote_path, pull_file)
                 local_fp = os.path.join(local_path, pull_file)
                 local_dir = os.path.dirname(local_fp)
@@ -172,7 +543,10 @@ class Client:
 
                 if os.path.isfile(local_fp):
                     local_stat = os.stat(local_fp)
-                    if local_stat.st_mtime >= pf_attr.st_mtime:
+                    if (
+                        local_stat.st_mtime >= pf_attr.st_mtime
+                        and local_stat.st_size == pf_attr.st_size
+                    ):
                         self._log.debug("skipping file %s", pull_file)
                         continue
 
@@ -184,8 +558,11 @@ class Client:
                 self._log.debug("local_fp: %s", local_fp)
                 self._log.debug("local_dir: %s", local_dir)
 
-                ftp_client.get(remote_fp, local_fp)
-                os.utime(local_fp, (pf_attr.st_atime, pf_attr.st_mtime))
+                with self.transfer_slots:
+                    self._pull_sftp_file(ftp_client, remote_fp, local_fp, pf_attr)
+                self.stats["pulled"] += 1
+            if on_entity_pulled is not None and entity_id:
+                on_entity_pulled(entity_id)
             self._log.info("pulled %d files to %s", counter, local_path)
         except Exception:
             self._log.error("could not pull files")
@@ -194,12 +571,90 @@ class Client:
             if ftp_client:
                 ftp_client.close()
 
+    def _pull_descriptors(self):
+        """Pull the small entity descriptors only, returning the selected entity ids"""
+        descriptor_exts = [f"{os.extsep}metadata"]
+        if self.entity_filter.needs_content:
+            descriptor_exts.append(f"{os.extsep}content")
+        self._pull_sftp_files(
+            self.args.file_path,
+            self.raw_backup_dir,
+            select=lambda name: os.path.splitext(name)[1] in descriptor_exts,
+        )
+
+        selected = self._select_entities(self._derive_metadata())
+        self._log.info("selected %d entities", len(selected))
+        return selected
+
+    def _list_remote_entities(self):
+        """List the ids of the entities on the tablet into remote_entity_ids, so
+        that the outputs of entities deleted there are cleaned up. The raw backup
+        of deleted entities is kept.
+        """
+        ftp_client = self.ssh_client.open_sftp()
+        try:
+            remote_ids = {
+                Client._entity_id(file_attr.filename)
+                for file_attr in ftp_client.listdir_attr(self.args.file_path)
+            }
+        finally:
+            ftp_client.close()
+        if not remote_ids:
+            self._log.warning("no entities on the tablet, keeping all outputs")
+            remote_ids = None
+        self.remote_entity_ids = remote_ids
+
     def pull_xochitl_files(self):
         """Copy files from remote xochitl directory to local raw backup directory.
         Keep the access and modified times of the file specified.
         """
         os.makedirs(self.raw_backup_dir, exist_ok=True)
-        self._pull_sftp_files(self.args.file_path, self.raw_backup_dir)
+        self._list_remote_entities()
+        if not self.entity_filter.active:
+            self._pull_sftp_files(self.args.file_path, self.raw_backup_dir)
+            return
+
+        # pull the small entity descriptors first, to resolve the selection
+        selected = self._pull_descriptors()
+        self._pull_sftp_files(
+            self.args.file_path,
+            self.raw_backup_dir,
+            select=lambda name: Client._entity_id(name) in selected,
+        )
+
+    def pull_pipelined(self):
+        """Pull the xochitl files, rendering each document in a worker process as
+        soon as all of its files have been pulled, overlapping transfer and render.
+        """
+        self.pull_template_files()
+        os.makedirs(self.raw_backup_dir, exist_ok=True)
+        os.makedirs(self.pdf_backup_dir, exist_ok=True)
+        os.makedirs(self.trash_backup_dir, exist_ok=True)
+
+        # descriptors first, so entity paths resolve before the documents land
+        self._list_remote_entities()
+        selected = self._pull_descriptors()
+        metadata = self._derive_metadata()
+
+        with self._backup_index() as index, self._render_pool() as executor:
+            self._clean_stale_outputs(
+                index, self.args.format, metadata, self.remote_entity_ids
+            )
+            futures = {}
+
+            def on_entity_pulled(meta_id):
+                job = self._conversion_job(meta_id, metadata, index)
+                if job is not None:
+                    self._log.info("rendering %s", job[-1])
+                    futures[executor.submit(_render_document, *job[:-1])] = job
+
+            self._pull_sftp_files(
+                self.args.file_path,
+                self.raw_backup_dir,
+                select=lambda name: Client._entity_id(name) in selected,
+                on_entity_pulled=on_entity_pulled,
+            )
+            self._wait_for_renders(futures, index)
 
     def pull_template_files(self):
         """Copy files from remote templates directory to local templates directory."""
@@ -217,6 +672,128 @@ class Client:
             metadata[meta_id] = meta
         return metadata
 
+    def _derive_content(self, meta_id):
+        content_fp = os.path.join(self.raw_backup_dir, f"{meta_id}{os.extsep}content")
+        if not os.path.isfile(content_fp):
+            return None
+        with open(content_fp, "r") as fh:
+            return json.load(fh)
+
+    def _select_entities(self, metadata):
+        """Get the set of entity ids matching the include and exclude filters"""
+        if not self.entity_filter.active:
+            return set(metadata.keys())
+
+        selected = set()
+        for meta_id, meta in metadata.items():
+            path, is_trash = Client._get_path(meta_id, metadata)
+            if is_trash:
+                path = os.path.join("trash", path)
+            content = None
+            if self.entity_filter.needs_content:
+                content = self._derive_content(meta_id)
+            if self.entity_filter.matches(meta_id, meta, path, content):
+                selected.add(meta_id)
+        return selected
+
+    def _derive_templates(self, meta_id):
+        pagedata_fp = os.path.join(self.raw_backup_dir, f"{meta_id}{os.extsep}pagedata")
+        if not os.path.isfile(pagedata_fp):
+            return []
+        with open(pagedata_fp, "r") as fh:
+            return [line.strip() for line in fh if line.strip()]
+
+    def _index_entities(self):
+        """Get the index rows of the live entities in the raw backup directory.
+        Entities deleted on the tablet, or missing from it when it was listed in
+        this run, are left out.
+        """
+        metadata = self._derive_metadata()
+        for meta_id, meta in metadata.items():
+            if meta.get("deleted", False):
+                continue
+            if self.remote_entity_ids is not None:
+                if meta_id not in self.remote_entity_ids:
+                    continue
+            try:
+                path, is_trash = Client._get_path(meta_id, metadata)
+            except RuntimeError:
+                self._log.warning("entity %s has a missing parent folder", meta_id)
+                continue
+            if is_trash:
+                path = os.path.join("trash", path)
+            content = self._derive_content(meta_id) or {}
+            page_count = content.get("pageCount")
+            if page_count is None and "pages" in content:
+                page_count = len(content["pages"])
+            yield {
+                "uuid": meta_id,
+                "name": meta.get("visibleName", ""),
+                "path": path,
+                "parent": meta.get("parent") or "",
+                "type": EntityFilter.entity_type(meta, content),
+                "page_count": page_count,
+                "last_modified": int(meta.get("lastModified", "0")),
+                "templates": self._derive_templates(meta_id),
+            }
+
+    @contextmanager
+    def _backup_index(self, populate=True):
+        """Open the local index, building it from the raw backup if it is new.
+        Callers about to rebuild the entities anyway pass populate=False.
+        """
+        index = BackupIndex(self.index_fp)
+        try:
+            if populate and index.created:
+                index.replace_entities(self._index_entities())
+            yield index
+        finally:
+            index.close()
+
+    def update_index(self):
+        """Rebuild the local query index from the raw backup descriptors"""
+        with self._backup_index(populate=False) as index:
+            count = index.replace_entities(self._index_entities())
+        self._log.info("indexed %d entities in %s", count, self.index_fp)
+
+    @staticmethod
+    def _format_entity(entity):
+        modified = datetime.fromtimestamp(entity["last_modified"] / 1000)
+        pages = "-" if entity["page_count"] is None else entity["page_count"]
+        name = entity["name"] + (os.sep if entity["type"] == "folder" else "")
+        return f"{entity['type']:<8} {pages:>5} {modified:%Y-%m-%d %H:%M}  {name}"
+
+    def query_index(self, action):
+        """Answer the ls, find and stat queries from the local index, built from
+        the raw backup directory if it does not exist yet.
+        """
+        query = self.args.query
+        with self._backup_index() as index:
+            if action == "ls":
+                entities = index.list_folder(query or "")
+                if entities is None:
+                    self._log.error("no such folder: %s", query)
+                    return
+                for entity in entities:
+                    print(Client._format_entity(entity))
+            elif action == "find":
+                for entity in index.find(query or "*"):
+                    suffix = os.sep if entity["type"] == "folder" else ""
+                    print(f"{entity['path']}{suffix}")
+            elif not query:
+                self._log.error("stat needs a --query path or uuid")
+            else:
+                entity = index.lookup(query)
+                if entity is None:
+                    self._log.error("no such entity: %s", query)
+                    return
+                for column in BackupIndex.COLUMNS:
+                    print(f"{column}: {entity[column]}")
+                modified = datetime.fromtimestamp(entity["last_modified"] / 1000)
+                print(f"modified: {modified.isoformat(sep=' ', timespec='seconds')}")
+                for template, pages in index.templates(entity["uuid"]):
+                    print(f"template: {template} ({pages} pages)")
+
     def _request_file_entity(self, session: Session, url: str, timeout=(9.03, 30.03)):
         headers = {
             "Host": self.args.destination,
@@ -247,19 +824,23 @@ class Client:
 
     def pull_pdf_files(self):
         """Use the web interface to download pdfs.
-        This should really be a conversion of the local xochitl files instead."""
+        Prefer convert-raw, which also annotates original PDFs locally."""
         os.makedirs(self.pdf_backup_dir, exist_ok=True)
         os.makedirs(self.trash_backup_dir, exist_ok=True)
         metadata = self._derive_metadata()
+        selected = self._select_entities(metadata)
 
         counter_ok = 0
         counter_total = 0
 
-        with Session() as session:
+        with Session() as session, self._backup_index() as index:
             adapter = adapters.HTTPAdapter(max_retries=0)
             session.mount("http://", adapter)
+            self._clean_stale_outputs(index, "pdf", metadata, self.remote_entity_ids)
 
             for meta_id, meta in metadata.items():
+                if meta_id not in selected:
+                    continue
                 path, is_trash = Client._get_path(meta_id, metadata)
                 self._log.debug(path)
                 self._log.debug(meta)
@@ -277,13 +858,12 @@ class Client:
                     path = os.path.join(local_dir, rel_fp)
                     os.makedirs(os.path.dirname(path), exist_ok=True)
 
-                    # if local file exists and has up-to-date modified time, ignore
                     last_modified = int(meta.get("lastModified", "0")) / 1000
-                    if os.path.isfile(path):
-                        local_stat = os.stat(path)
-                        if local_stat.st_mtime >= last_modified:
-                            self._log.debug("skipping %s", rel_fp)
-                            continue
+                    if self._output_up_to_date(
+                        index, "pdf", meta_id, meta, path, last_modified
+                    ):
+                        self._log.debug("skipping %s", rel_fp)
+                        continue
 
                     self._log.info("retrieving %s", rel_fp)
                     url = (
@@ -294,6 +874,7 @@ class Client:
                         with open(path, "wb") as fh:
                             fh.write(res.content)
                         os.utime(path, (last_modified, last_modified))
+                        self._track_output(index, "pdf", meta_id, path)
                         counter_ok += 1
                     except Exception:
                         self._log.warning("skipping %s", rel_fp)
@@ -317,41 +898,425 @@ class Client:
             self.args.backup_dir,
         )
 
-    def convert_xochitl_files(self):
-        os.makedirs(self.pdf_backup_dir, exist_ok=True)
-        os.makedirs(self.trash_backup_dir, exist_ok=True)
-
-        metadata = self._derive_metadata()
-        meta_fps = glob(os.path.join(self.raw_backup_dir, "*.metadata"))
-        for meta_fp in meta_fps:
-            uuid_fp = os.path.splitext(meta_fp)[0]
-            if not os.path.isdir(uuid_fp):
-                self._log.debug("skipping %s", meta_fp)
-                continue
-            meta_id = os.path.basename(uuid_fp)
-            meta = metadata[meta_id]
+    def _conversion_job(self, meta_id, metadata, index: BackupIndex):
+        """Get the _render_document arguments and display path for the entity.
+        Returns None if the entity has nothing to render or its output is up to date.
+        """
+        output_format = self.args.format
+        meta = metadata.get(meta_id)
+        uuid_fp = os.path.join(self.raw_backup_dir, meta_id)
+        pdf_fp = f"{uuid_fp}{os.extsep}pdf"
+        has_source = os.path.isdir(uuid_fp) or (
+            output_format == "pdf" and os.path.isfile(pdf_fp)
+        )
+        if meta is None or not has_source:
+            self._log.debug("skipping %s", uuid_fp)
+            return None
 
+        if output_format == "columnar":
+            # flat uuid named directories, the index maps them to the visible paths
+            rel_fp = meta_id
+            path = os.path.join(self.columnar_dir, rel_fp)
+            disp_fp = os.path.join("columnar", rel_fp)
+        else:
             path, is_trash = Client._get_path(meta_id, metadata)
             local_dir = self.trash_backup_dir if is_trash else self.pdf_backup_dir
             rel_fp = f"{path}{os.path.extsep}pdf"
             path = os.path.join(local_dir, rel_fp)
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-
-            # if local file exists and has up-to-date modified time, ignore
-            last_modified = int(meta.get("lastModified", "0")) / 1000
-            if os.path.isfile(path):
-                local_stat = os.stat(path)
-                if local_stat.st_mtime >= last_modified:
-                    self._log.debug("skipping %s", rel_fp)
-                    continue
-
-            converter = ConvertRM(uuid_fp, self.templates_dir, logger=self._log)
-
             disp_fp = (
                 os.path.join("trash", rel_fp)
                 if is_trash
                 else os.path.join("My files", rel_fp)
             )
-            self._log.info("rendering %s", disp_fp)
-            converter.convert_document(path)
-            os.utime(path, (last_modified, last_modified))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        last_modified = int(meta.get("lastModified", "0")) / 1000
+        if self._output_up_to_date(
+            index, output_format, meta_id, meta, path, last_modified
+        ):
+            self._log.debug("skipping %s", rel_fp)
+            return None
+        return uuid_fp, self.templates_dir, path, last_modified, output_format, disp_fp
+
+    def _fingerprint(self, meta_id):
+        """Fingerprint the raw files the entity output is rendered from: the page .rm
+        files, the original document and the .content and .pagedata descriptors.
+        The .metadata is left out, so renames and moves keep the fingerprint.
+        Returns None if the raw backup has no document data for the entity.
+        """
+        uuid_fp = os.path.join(self.raw_backup_dir, meta_id)
+        stat_fps = [f"{uuid_fp}{os.extsep}{ext}" for ext in Client.SOURCE_FILE_TYPES]
+        stat_fps = [fp for fp in stat_fps if os.path.isfile(fp)]
+        if os.path.isdir(uuid_fp):
+            stat_fps += sorted(glob(os.path.join(escape(uuid_fp), f"*{os.extsep}rm")))
+        elif not stat_fps:
+            return None
+
+        digest = hashlib.sha256()
+        for ext in ("content", "pagedata"):
+            descriptor_fp = f"{uuid_fp}{os.extsep}{ext}"
+            if os.path.isfile(descriptor_fp):
+                with open(descriptor_fp, "rb") as fh:
+                    digest.update(fh.read())
+        # pulled files keep the tablet modified time, so the stat identifies them
+        for stat_fp in stat_fps:
+            file_stat = os.stat(stat_fp)
+            rel_fp = os.path.relpath(stat_fp, self.raw_backup_dir)
+            digest.update(
+                f"{rel_fp}:{file_stat.st_size}:{int(file_stat.st_mtime)}".encode()
+            )
+        return digest.hexdigest()
+
+    def _remove_output(self, output_fp):
+        """Remove the output file, or columnar directory, and any parent folders
+        left empty
+        """
+        is_columnar = os.path.dirname(output_fp) == self.columnar_dir
+        if os.path.isfile(output_fp):
+            os.remove(output_fp)
+        elif is_columnar and os.path.isdir(output_fp):
+            rmtree(output_fp)
+        roots = (
+            self.backup_dir,
+            self.pdf_backup_dir,
+            self.trash_backup_dir,
+            self.columnar_dir,
+        )
+        output_dir = os.path.dirname(output_fp)
+        while output_dir not in roots and output_dir.startswith(self.backup_dir):
+            try:
+                os.rmdir(output_dir)
+            except OSError:
+                break
+            output_dir = os.path.dirname(output_dir)
+
+    @staticmethod
+    def _retitle_pdf(pdf_fp, title):
+        """Update the document title of the PDF, keeping its content and mtime"""
+        file_stat = os.stat(pdf_fp)
+        writer = PdfWriter(clone_from=pdf_fp)
+        writer.add_metadata({"/Subject": title, "/Title": f"{title}{os.extsep}pdf"})
+        tmp_fp = f"{pdf_fp}{os.extsep}part"
+        with open(tmp_fp, "wb") as fh:
+            writer.write(fh)
+        os.replace(tmp_fp, pdf_fp)
+        os.utime(pdf_fp, (file_stat.st_atime, file_stat.st_mtime))
+
+    def _output_up_to_date(self, index, kind, meta_id, meta, path, last_modified):
+        """Check if the entity output at path is up to date, tracking it by uuid.
+        A tracked output with a matching fingerprint only had its metadata changed,
+        it is moved to path rather than rendered again. Untracked outputs fall back
+        to comparing the file modified time with the entity lastModified, they are
+        only tracked once rendered, as their content is not known to be complete.
+        """
+        fingerprint = self._fingerprint(meta_id)
+        tracked = index.tracked_output(meta_id, kind)
+        if tracked is not None and fingerprint is not None:
+            tracked_fp = os.path.join(self.backup_dir, tracked["path"])
+            if not os.path.exists(tracked_fp):
+                index.untrack_output(meta_id, kind)
+            elif tracked["fingerprint"] != fingerprint:
+                if tracked_fp != path:
+                    self._remove_output(tracked_fp)
+                return False
+            else:
+                if tracked_fp != path:
+                    self._log.info(
+                        "moving %s to %s",
+                        tracked["path"],
+                        os.path.relpath(path, self.backup_dir),
+                    )
+                    os.replace(tracked_fp, path)
+                    self._remove_output(tracked_fp)
+                    if kind == "pdf":
+                        Client._retitle_pdf(path, meta.get("visibleName", ""))
+                    self._track_output(index, kind, meta_id, path, fingerprint)
+                    self.stats["moved"] += 1
+                return True
+
+        # if local file exists and has up-to-date modified time, ignore
+        return os.path.exists(path) and os.stat(path).st_mtime >= last_modified
+
+    def _track_output(self, index, kind, meta_id, path, fingerprint=None):
+        """Record the output of the entity, if its raw document data is backed up"""
+        if fingerprint is None:
+            fingerprint = self._fingerprint(meta_id)
+        if fingerprint is not None:
+            rel_fp = os.path.relpath(path, self.backup_dir)
+            index.track_output(meta_id, kind, rel_fp, fingerprint)
+
+    def _track_rendered(self, index, job):
+        uuid_fp, _, path, _, output_format = job[:5]
+        self._track_output(index, output_format, os.path.basename(uuid_fp), path)
+        self.stats["rendered"] += 1
+
+    def _clean_stale_outputs(self, index, kind, metadata, remote_ids=None):
+        """Remove the tracked outputs of entities deleted from the backup, or from
+        the tablet if the remote_ids of the entities on it are given
+        """
+        for tracked in index.tracked_outputs(kind):
+            meta = metadata.get(tracked["uuid"])
+            on_tablet = remote_ids is None or tracked["uuid"] in remote_ids
+            if meta is not None and not meta.get("deleted", False) and on_tablet:
+                continue
+            self._log.info("removing %s, deleted on the tablet", tracked["path"])
+            self._remove_output(os.path.join(self.backup_dir, tracked["path"]))
+            index.untrack_output(tracked["uuid"], kind)
+
+    @contextmanager
+    def _render_pool(self):
+        """Get the shared render executor, or a process pool for this client"""
+        if self.render_executor is not None:
+            yield self.render_executor
+            return
+        with Client.render_process_pool(self.args.jobs) as executor:
+            yield executor
+
+    @staticmethod
+    def render_process_pool(jobs: int):
+        """Get a process pool for rendering. Workers start from a fork server
+        rather than forking this process, whose running threads (paramiko
+        transports, fleet devices) could leave held locks in the forked workers.
+        """
+        start_method = "spawn"
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            start_method = "forkserver"
+        mp_context = multiprocessing.get_context(start_method)
+        return ProcessPoolExecutor(max_workers=max(1, jobs), mp_context=mp_context)
+
+    def _wait_for_renders(self, futures, index: BackupIndex):
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                self._log.error("could not render %s", futures[future][-1])
+                raise
+            self._track_rendered(index, futures[future])
+
+    def convert_xochitl_files(self):
+        os.makedirs(self.pdf_backup_dir, exist_ok=True)
+        os.makedirs(self.trash_backup_dir, exist_ok=True)
+
+        metadata = self._derive_metadata()
+        selected = self._select_entities(metadata)
+        if self.remote_entity_ids is not None:
+            # deleted on the tablet, only the raw backup is kept
+            selected &= self.remote_entity_ids
+        with self._backup_index() as index:
+            self._clean_stale_outputs(
+                index, self.args.format, metadata, self.remote_entity_ids
+            )
+            jobs = []
+            for meta_id in sorted(selected):
+                job = self._conversion_job(meta_id, metadata, index)
+                if job is not None:
+                    jobs.append(job)
+
+            if self.args.jobs <= 1 and self.render_executor is None:
+                for job in jobs:
+                    self._log.info("rendering %s", job[-1])
+                    _render_document(*job[:-1])
+                    self._track_rendered(index, job)
+                return
+
+            # a single long document would otherwise set the wall-clock time
+            large_jobs = [job for job in jobs if self._is_page_parallel(job)]
+            with self._render_pool() as executor:
+                futures = {}
+                for job in jobs:
+                    if job in large_jobs:
+                        continue
+                    self._log.info("rendering %s", job[-1])
+                    futures[executor.submit(_render_document, *job[:-1])] = job
+
+                # pages queue behind the documents, keeping all of the workers busy
+                for job in large_jobs:
+                    self._log.info("rendering %s page by page", job[-1])
+                    _render_document(*job[:-1], page_executor=executor)
+                    self._track_rendered(index, job)
+                self._wait_for_renders(futures, index)
+
+    def _is_page_parallel(self, job):
+        """Check if the conversion job is a PDF with enough pages to split"""
+        uuid_fp, output_format = job[0], job[4]
+        if output_format != "pdf":
+            return False
+        content = self._derive_content(os.path.basename(uuid_fp)) or {}
+        page_count = content.get("pageCount") or len(content.get("pages", []))
+        return page_count >= Client.PAGE_PARALLEL_MIN_PAGES
+
+    def _push_candidates(self):
+        """Get the local pdf and epub files to push, walking any directories"""
+        candidates = []
+        for push_path in self.args.push_path or []:
+            if os.path.isdir(push_path):
+                for root, _, filenames in os.walk(push_path):
+                    for filename in sorted(filenames):
+                        candidates.append(os.path.join(root, filename))
+            elif os.path.isfile(push_path):
+                candidates.append(push_path)
+            else:
+                self._log.warning("push path not found: %s", push_path)
+
+        return [
+            candidate
+            for candidate in candidates
+            if Client._push_file_type(candidate) in Client.PUSH_FILE_TYPES
+        ]
+
+    @staticmethod
+    def _push_file_type(fp):
+        return os.path.splitext(fp)[1].lstrip(os.extsep).lower()
+
+    @staticmethod
+    def _file_hash(fp):
+        file_hash = hashlib.sha256()
+        with open(fp, "rb") as fh:
+            for chunk in iter(lambda: fh.read(Client.TRANSFER_CHUNK_SIZE), b""):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    def _remote_hashes(self, sizes):
+        """Get the content hashes of the device documents matching the given sizes.
+        Only same sized documents can be duplicates, so only those are hashed.
+        """
+        ftp_client = self.ssh_client.open_sftp()
+        try:
+            file_attrs = ftp_client.listdir_attr(self.args.file_path)
+        finally:
+            ftp_client.close()
+
+        candidates = [
+            file_attr.filename
+            for file_attr in file_attrs
+            if Client._push_file_type(file_attr.filename) in Client.PUSH_FILE_TYPES
+            and file_attr.st_size in sizes
+        ]
+        if not candidates:
+            return set()
+
+        command = f"cd {quote(self.args.file_path)} && sha256sum " + " ".join(
+            quote(candidate) for candidate in candidates
+        )
+        exit_status, stdout, stderr = self._exec_command(command)
+        if exit_status != 0:
+            self._log.warning("could not hash device documents: %s", stderr)
+        return {line.split()[0] for line in stdout.decode().splitlines() if line}
+
+    @staticmethod
+    def _xochitl_entity(local_fp, file_type, last_modified):
+        """Generate the xochitl .metadata and .content for a pushed document"""
+        metadata = {
+            "deleted": False,
+            "lastModified": str(last_modified),
+            "lastOpenedPage": 0,
+            "metadatamodified": False,
+            "modified": False,
+            "parent": "",
+            "pinned": False,
+            "synced": False,
+            "type": "DocumentType",
+            "version": 0,
+            "visibleName": os.path.splitext(os.path.basename(local_fp))[0],
+        }
+        content = {
+            "extraMetadata": {},
+            "fileType": file_type,
+            "fontName": "",
+            "lastOpenedPage": 0,
+            "lineHeight": -1,
+            "margins": 100,
+            "orientation": "portrait",
+            "pageCount": 0,
+            "textScale": 1,
+            "transform": {
+                "m11": 1,
+                "m12": 0,
+                "m13": 0,
+                "m21": 0,
+                "m22": 1,
+                "m23": 0,
+                "m31": 0,
+                "m32": 0,
+                "m33": 1,
+            },
+        }
+        return metadata, content
+
+    @staticmethod
+    def _tar_owner(tar_info: tarfile.TarInfo):
+        tar_info.uid = tar_info.gid = 0
+        tar_info.uname = tar_info.gname = "root"
+        return tar_info
+
+    @staticmethod
+    def _tar_add_bytes(tar: tarfile.TarFile, name, data: bytes, mtime):
+        tar_info = Client._tar_owner(tarfile.TarInfo(name))
+        tar_info.size = len(data)
+        tar_info.mtime = mtime
+        tar.addfile(tar_info, BytesIO(data))
+
+    def push_files(self):
+        """Upload local pdf and epub files to the tablet in one batched tar stream.
+        Files whose content hash is already on the device are skipped, and xochitl
+        is restarted once for the whole batch.
+        """
+        candidates = self._push_candidates()
+        local_hashes = {}
+        for local_fp in candidates:
+            local_hashes.setdefault(Client._file_hash(local_fp), local_fp)
+
+        remote_hashes = self._remote_hashes(
+            {os.path.getsize(local_fp) for local_fp in local_hashes.values()}
+        )
+        push_fps = []
+        for file_hash, local_fp in local_hashes.items():
+            if file_hash in remote_hashes:
+                self._log.info("skipping %s, already on device", local_fp)
+                continue
+            push_fps.append(local_fp)
+
+        if not push_fps:
+            self._log.info("pushed 0/%d files", len(candidates))
+            return
+
+        now = time.time()
+        last_modified = int(now * 1000)
+
+        def write_tar(stdin):
+            with tarfile.open(fileobj=stdin, mode="w|") as tar:
+                for local_fp in push_fps:
+                    file_type = Client._push_file_type(local_fp)
+                    metadata, content = Client._xochitl_entity(
+                        local_fp, file_type, last_modified
+                    )
+                    meta_id = str(uuid4())
+                    self._log.info("pushing %s as %s", local_fp, meta_id)
+                    for ext, data in (
+                        ("metadata", json.dumps(metadata, indent=4).encode()),
+                        ("content", json.dumps(content, indent=4).encode()),
+                        ("pagedata", b""),
+                    ):
+                        Client._tar_add_bytes(
+                            tar, f"{meta_id}{os.extsep}{ext}", data, now
+                        )
+                    tar.add(
+                        local_fp,
+                        arcname=f"{meta_id}{os.extsep}{file_type}",
+                        recursive=False,
+                        filter=Client._tar_owner,
+                    )
+
+        with self.transfer_slots:
+            exit_status, _, stderr = self._exec_command(
+                f"tar -x -f - -C {quote(self.args.file_path)}", stdin_writer=write_tar
+            )
+        if exit_status != 0:
+            raise RuntimeError(f"could not push files: {stderr.decode().strip()}")
+
+        # xochitl only picks up new documents on restart
+        exit_status, _, stderr = self._exec_command("systemctl restart xochitl")
+        if exit_status != 0:
+            self._log.warning("could not restart xochitl: %s", stderr.decode().strip())
+        self.stats["pushed"] += len(push_fps)
+        self._log.info("pushed %d/%d files", len(push_fps), len(candidates))
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+from io import BufferedReader
+from shutil import rmtree
+from struct import calcsize, unpack_from
+
+from .convert_rm import ConvertRM
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# per point columns, decoded straight from the .rm segment structs
+POINT_FIELDS = ("x", "y", "speed", "tilt", "width", "pressure")
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError(
+            "the columnar format needs numpy, install remarkable-cli[columnar]"
+        )
+
+
+def read_columns(fh: BufferedReader):
+    """Decode a .rm lines file into stroke and point arrays.
+    The point structs of all strokes are decoded in one vectorized pass, rather
+    than into a tuple per point.
+
+    Returns a dict of the stroke arrays (layer, pen, colour, base width, number
+    of points) and the (num_points, 6) float32 array of POINT_FIELDS.
+    """
+    _require_numpy()
+    stroke_fmt, num_layers = ConvertRM.read_lines_header(fh)
+    stroke_size = calcsize(stroke_fmt)
+    segment_size = calcsize(ConvertRM.SEGMENT_FMT)
+
+    strokes = []
+    chunks = []
+    for layer_idx in range(num_layers):
+        fmt = "<I"
+        (num_strokes,) = unpack_from(fmt, fh.read(calcsize(fmt)))
+        for stroke_idx in range(num_strokes):
+            stroke_data = unpack_from(stroke_fmt, fh.read(stroke_size))
+            pen_idx, colour_idx, _, stroke_width = stroke_data[:4]
+            num_points = stroke_data[-1]
+            strokes.append((layer_idx, pen_idx, colour_idx, stroke_width, num_points))
+            chunks.append(fh.read(segment_size * num_points))
+
+    stroke_columns = np.array(strokes, dtype=np.float64).reshape(-1, 5)
+    points = np.frombuffer(b"".join(chunks), dtype="<f4").reshape(-1, 6)
+    return {
+        "layer": stroke_columns[:, 0].astype(np.int32),
+        "pen": stroke_columns[:, 1].astype(np.int32),
+        "colour": stroke_columns[:, 2].astype(np.int32),
+        "base_width": stroke_columns[:, 3].astype(np.float32),
+        "num_points": stroke_columns[:, 4].astype(np.int64),
+    }, points
+
+
+def export_columnar(converter: ConvertRM, output_dir: os.PathLike):
+    """Write the strokes of all document pages as columnar arrays, one .npy file
+    per column in output_dir, replacing any previous export.
+
+    Stroke arrays, indexed by the document wide stroke id:
+    stroke_page, stroke_layer, stroke_pen, stroke_colour, stroke_width (the pen
+    size setting) and stroke_offsets (start of each stroke in the point arrays,
+    with a final end offset).
+    Point arrays: page, layer and stroke ids, then the POINT_FIELDS.
+    Pages are indexed into page_ids, the document uuid is stored in document.
+
+    Plain .npy files can be memory mapped, np.load(fp, mmap_mode="r"), so each
+    column is read on access without loading the others.
+    """
+    _require_numpy()
+    log = logging.getLogger(__name__)
+    page_strokes = []
+    page_points = []
+    for page_idx, page_id in enumerate(converter.page_ids):
+        pg_rm_fp = os.path.join(converter.pages_fp, f"{page_id}{os.extsep}rm")
+        if not os.path.isfile(pg_rm_fp):
+            log.debug(f"skipping {pg_rm_fp}")
+            continue
+        with open(pg_rm_fp, "rb") as fh:
+            stroke_columns, points = read_columns(fh)
+        stroke_columns["page"] = np.full_like(stroke_columns["layer"], page_idx)
+        page_strokes.append(stroke_columns)
+        page_points.append(points)
+
+    def concat_strokes(key, dtype):
+        arrays = [strokes[key] for strokes in page_strokes]
+        return np.concatenate(arrays) if arrays else np.zeros(0, dtype=dtype)
+
+    num_points = concat_strokes("num_points", np.int64)
+    stroke_offsets = np.zeros(len(num_points) + 1, dtype=np.int64)
+    np.cumsum(num_points, out=stroke_offsets[1:])
+    stroke_ids = np.repeat(np.arange(len(num_points), dtype=np.int32), num_points)
+    points = (
+        np.concatenate(page_points)
+        if page_points
+        else np.zeros((0, len(POINT_FIELDS)), dtype=np.float32)
+    )
+
+    columns = {
+        "document": np.array(os.path.basename(converter.pages_fp)),
+        "page_ids": np.array(converter.page_ids, dtype=str),
+        "stroke_page": concat_strokes("page", np.int32),
+        "stroke_layer": concat_strokes("layer", np.int32),
+        "stroke_pen": concat_strokes("pen", np.int32),
+        "stroke_colour": concat_strokes("colour", np.int32),
+        "stroke_width": concat_strokes("base_width", np.float32),
+        "stroke_offsets": stroke_offsets,
+        "stroke": stroke_ids,
+    }
+    columns["page"] = columns["stroke_page"][stroke_ids]
+    columns["layer"] = columns["stroke_layer"][stroke_ids]
+    for field_idx, field in enumerate(POINT_FIELDS):
+        columns[field] = np.ascontiguousarray(points[:, field_idx])
+
+    # write next to the output, readers never see a partial export
+    tmp_dir = f"{output_dir}{os.extsep}part"
+    old_dir = f"{output_dir}{os.extsep}old"
+    for stale_dir in (tmp_dir, old_dir):
+        if os.path.isdir(stale_dir):
+            rmtree(stale_dir)
+    os.makedirs(tmp_dir)
+    for name, column in columns.items():
+        np.save(os.path.join(tmp_dir, f"{name}{os.extsep}npy"), column)
+    # a directory cannot replace a non-empty one, so the previous export is renamed
+    # aside and only removed once the new one is in place. The output is missing
+    # only between the two renames, never left partial or absent on failure
+    if os.path.isdir(output_dir):
+        os.replace(output_dir, old_dir)
+    try:
+        os.replace(tmp_dir, output_dir)
+    except OSError:
+        if os.path.isdir(old_dir):
+            os.replace(old_dir, output_dir)
+        raise
+    if os.path.isdir(old_dir):
+        rmtree(old_dir)
@@ -6,14 +6,20 @@ import logging
 import os
 import re
 import xml.etree.ElementTree as ET
-from io import BufferedReader
-from struct import calcsize, unpack_from
+from collections import deque
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from io import BufferedReader, BytesIO
+from struct import calcsize, iter_unpack, unpack_from
 from tempfile import TemporaryFile
 
+from pypdf import PdfReader, PdfWriter, Transformation
 from reportlab.graphics import renderPDF
 from reportlab.pdfgen.canvas import Canvas
 from svglib.svglib import svg2rlg
 
+from .geometry import stroke_outline
+from .pdf_stream import PDFStreamWriter
 from .pens import (
     Ballpoint,
     Brush,
@@ -29,11 +35,42 @@ from .pens import (
 )
 
 
+@contextmanager
+def _open_output(output_path: os.PathLike):
+    """Open a .part file to write the output into, replacing output_path only once
+    the output is complete. A failed render leaves any previous output as is.
+    """
+    part_fp = f"{output_path}{os.extsep}part"
+    try:
+        with open(part_fp, "wb") as fh:
+            yield fh
+        os.replace(part_fp, output_path)
+    except BaseException:
+        if os.path.isfile(part_fp):
+            os.remove(part_fp)
+        raise
+
+
+def _render_page_worker(pg_rm_fp: str, templates_path: str, template_name: str):
+    """Render a single page .rm file into PDF bytes, runs in a worker process.
+    A template_name of None renders a transparent overlay for the original PDF page.
+    """
+    log = logging.getLogger(__name__)
+    template_tree = ConvertRM._load_template(templates_path, template_name, log)
+    return ConvertRM._render_page_pdf(pg_rm_fp, template_tree, log).getvalue()
+
+
 class ConvertRM:
     """Partial support for version 2.5.0.27 generated lines files."""
 
     X_SIZE = 1404
     Y_SIZE = 1872
+    # strokes varying in width by more than this are drawn as filled outlines
+    WIDTH_TOLERANCE = 0.25
+    # x, y, speed, tilt, width, pressure of every stroke point
+    SEGMENT_FMT = "<ffffff"
+    # pages submitted to the executor ahead of the page being merged
+    PAGE_WINDOW = 32
 
     STROKE_COLOUR = {
         0: "#000000",
@@ -70,6 +107,22 @@ class ConvertRM:
         svg_root.append(blank_layer)
         return ET.ElementTree(svg_root)
 
+    @staticmethod
+    def _overlay_template():
+        """Transparent svg root, used for annotating pages of an existing PDF"""
+        svg_root = ET.Element(
+            "svg",
+            {
+                "xmlns": "http://www.w3.org/2000/svg",
+                "xmlns:xlink": "http://www.w3.org/1999/xlink",
+                "version": "1.1",
+                "x": "0px",
+                "y": "0px",
+                "viewBox": f"0 0 {ConvertRM.X_SIZE} {ConvertRM.Y_SIZE}",
+            },
+        )
+        return ET.ElementTree(svg_root)
+
     def __init__(
         self,
         entity_path: os.PathLike,
@@ -80,6 +133,8 @@ class ConvertRM:
         entity_path should be:
         - path to {uuid}.(content|metadata), without extension.
         - path to directory containing pages (.rm) files, without trailing slash
+
+        If the original {uuid}.pdf exists, the pages are overlaid onto it.
         """
         self._log = logger
         if logger is None:
@@ -87,7 +142,8 @@ class ConvertRM:
             logging.basicConfig(format=log_format, level=logging.INFO)
             self._log = logging.getLogger(__name__)
 
-        if not os.path.isdir(entity_path):
+        self.pdf_fp = f"{entity_path}{os.extsep}pdf"
+        if not os.path.isdir(entity_path) and not os.path.isfile(self.pdf_fp):
             self._log.error("not found: %s", entity_path)
             raise FileNotFoundError(entity_path)
         self.pages_fp = entity_path
@@ -113,7 +169,11 @@ class ConvertRM:
                 with open(pg_meta_fp, "r") as fh:
                     self.pages_metadata[page_id] = json.load(fh)
 
-    def _convert_rm_to_svg(self, fh: BufferedReader, template_tree: ET.ElementTree):
+    @staticmethod
+    def read_lines_header(fh: BufferedReader):
+        """Decode the .rm lines file header, returning the stroke struct format
+        for the file version and the number of layers.
+        """
         raw_header_template = "reMarkable .lines file, version=#          "
         fmt = f"<{len(raw_header_template)}sI"
         header, num_layers = unpack_from(fmt, fh.read(calcsize(fmt)))
@@ -129,118 +189,334 @@ class ConvertRM:
         stroke_fmt = "<IIIfII"  # Version 5
         if int(version) < 5:
             stroke_fmt = "<IIIfI"  # Version 3 (anything pre 5)
+        return stroke_fmt, num_layers
 
-        svg_root = template_tree.getroot()
+    @staticmethod
+    def read_lines(fh: BufferedReader):
+        """Decode a .rm lines file into a list of layers.
+        Each layer is a list of (stroke_data, segments) strokes, where segments is
+        a list of (x, y, speed, tilt, width, pressure) tuples.
+        """
+        stroke_fmt, num_layers = ConvertRM.read_lines_header(fh)
+        segment_fmt = ConvertRM.SEGMENT_FMT
 
+        layers = []
         for layer_idx in range(num_layers):
             fmt = "<I"
             (num_strokes,) = unpack_from(fmt, fh.read(calcsize(fmt)))
 
-            svg_layer = ET.Element("g")
-
+            strokes = []
             for stroke_idx in range(num_strokes):
                 stroke_data = unpack_from(stroke_fmt, fh.read(calcsize(stroke_fmt)))
-
-                pen_idx, colour_idx, i_unk, stroke_width = stroke_data[:4]
                 num_segments = stroke_data[-1]
-                stroke_color = ConvertRM.STROKE_COLOUR.get(colour_idx, "black")
-
-                if pen_idx in (2, 15):
-                    pen = Ballpoint(stroke_width, stroke_color)
-                elif pen_idx in (4, 17):
-                    pen = Fineliner(stroke_width, stroke_color)
-                elif pen_idx in (3, 16):
-                    pen = Marker(stroke_width, stroke_color)
-                elif pen_idx in (1, 14):
-                    pen = Pencil(stroke_width)
-                elif pen_idx in (7, 13):
-                    pen = MechanicalPencil(stroke_width)
-                elif pen_idx in (0, 12):
-                    pen = Brush(stroke_width, stroke_color)
-                elif pen_idx in (5, 18):
-                    pen = Highlighter()
-                elif pen_idx in (21,):
-                    pen = Calligraphy(stroke_width, stroke_color)
-                elif pen_idx in (8,):
-                    pen = EraseArea()
-                elif pen_idx in (6,):
-                    pen = Eraser(stroke_width)
-                else:
-                    self._log.warning("unknown pen type %d", pen_idx)
-                    pen = Pen()
+                segments = list(
+                    iter_unpack(
+                        segment_fmt, fh.read(calcsize(segment_fmt) * num_segments)
+                    )
+                )
+                strokes.append((stroke_data, segments))
+            layers.append(strokes)
+        return layers
 
-                svg_layer.append(ET.Comment(f"Stroke: {stroke_data}"))
+    @staticmethod
+    def _get_pen(pen_idx, colour_idx, stroke_width, log: logging.Logger):
+        stroke_color = ConvertRM.STROKE_COLOUR.get(colour_idx, "black")
+
+        if pen_idx in (2, 15):
+            return Ballpoint(stroke_width, stroke_color)
+        elif pen_idx in (4, 17):
+            return Fineliner(stroke_width, stroke_color)
+        elif pen_idx in (3, 16):
+            return Marker(stroke_width, stroke_color)
+        elif pen_idx in (1, 14):
+            return Pencil(stroke_width)
+        elif pen_idx in (7, 13):
+            return MechanicalPencil(stroke_width)
+        elif pen_idx in (0, 12):
+            return Brush(stroke_width, stroke_color)
+        elif pen_idx in (5, 18):
+            return Highlighter()
+        elif pen_idx in (21,):
+            return Calligraphy(stroke_width, stroke_color)
+        elif pen_idx in (8,):
+            return EraseArea()
+        elif pen_idx in (6,):
+            return Eraser(stroke_width)
+        log.warning("unknown pen type %d", pen_idx)
+        return Pen()
 
-                line_points = []
-                for segment_idx in range(num_segments):
-                    fmt = "<ffffff"
-                    segment = unpack_from(fmt, fh.read(calcsize(fmt)))
-                    x_pos, y_pos, speed, tilt, width, pressure = segment
-                    pt = f"{x_pos},{y_pos}"
+    @staticmethod
+    def _stroke_element(pen: Pen, segments):
+        """Get the svg element for a stroke, or None if the stroke is invisible.
+        Strokes with a varying width become a single filled outline path,
+        other strokes a single polyline.
+        """
+        widths = [pen.get_segment_width(*segment[2:]) for segment in segments]
+        opacities = [pen.get_segment_opacity(*segment[2:]) for segment in segments]
+        opacity = min(max(0.0, sum(opacities) / len(opacities)), 1.0)
+        if opacity <= 0:
+            return None
+
+        points = [(x_pos, y_pos) for x_pos, y_pos, *_ in segments]
+        if max(widths) - min(widths) > ConvertRM.WIDTH_TOLERANCE:
+            outline = stroke_outline(points, widths, stroke_cap=pen.stroke_cap)
+            # self overlapping outlines must stay filled, so use the nonzero rule
+            path_data = " L ".join(f"{x:.2f},{y:.2f}" for x, y in outline)
+            return ET.Element(
+                "path",
+                {
+                    "fill": pen.color,
+                    "fill-opacity": f"{opacity:.3f}",
+                    "fill-rule": "nonzero",
+                    "stroke": "none",
+                    "d": f"M {path_data} Z",
+                },
+            )
 
-                    if (line_points and line_points[-1] != pt) or not line_points:
-                        line_points.append(pt)
+        line_points = []
+        for x_pos, y_pos in points:
+            pt = f"{x_pos},{y_pos}"
+            if not line_points or line_points[-1] != pt:
+                line_points.append(pt)
+        attrs = pen.get_polyline_attributes(*segments[0][2:])
+        attrs["stroke-width"] = f"{sum(widths) / len(widths):.3f}"
+        attrs["stroke-opacity"] = f"{opacity:.3f}"
+        attrs["points"] = " ".join(line_points)
+        return ET.Element("polyline", attrs)
 
-                    if pen.segment_length < 0 or segment_idx % pen.segment_length != 0:
-                        continue
+    @staticmethod
+    def _convert_rm_to_svg(
+        fh: BufferedReader, template_tree: ET.ElementTree, log: logging.Logger
+    ):
+        svg_root = template_tree.getroot()
 
-                    attrs = pen.get_polyline_attributes(speed, tilt, width, pressure)
-                    attrs["points"] = " ".join(line_points)
-                    svg_polyline = ET.Element("polyline", attrs)
-                    svg_layer.append(svg_polyline)
-                    line_points = [pt]
+        for strokes in ConvertRM.read_lines(fh):
+            svg_layer = ET.Element("g")
 
-                attrs = pen.get_polyline_attributes(speed, tilt, width, pressure)
-                attrs["points"] = " ".join(line_points)
-                svg_polyline = ET.Element("polyline", attrs)
-                svg_layer.append(svg_polyline)
+            for stroke_data, segments in strokes:
+                pen_idx, colour_idx, i_unk, stroke_width = stroke_data[:4]
+                pen = ConvertRM._get_pen(pen_idx, colour_idx, stroke_width, log)
+
+                svg_layer.append(ET.Comment(f"Stroke: {stroke_data}"))
+                if not segments:
+                    continue
+                svg_element = ConvertRM._stroke_element(pen, segments)
+                if svg_element is not None:
+                    svg_layer.append(svg_element)
 
             svg_root.append(svg_layer)
         # self._log.debug(ET.tostring(svg_root))
         return template_tree
 
-    def convert_document(
-        self, pdf_output_path: os.PathLike, creator="awwong1/remarkable-cli"
+    @staticmethod
+    def _render_page_pdf(
+        pg_rm_fp: str, template_tree: ET.ElementTree, log: logging.Logger
     ):
-        pdf_output = Canvas(pdf_output_path)
-        title = self.metadata.get("visibleName", "Untitled")
-        pdf_output.setSubject(title)
-        title_ext = f"{title}{os.extsep}pdf"
-        pdf_output.setTitle(title_ext)
-        pdf_output.setCreator(creator)
+        """Render a single page into an in-memory, single page PDF"""
+        with open(pg_rm_fp, "rb") as fh:
+            template_tree = ConvertRM._convert_rm_to_svg(fh, template_tree, log)
+
+        with TemporaryFile(mode="w+b") as tf:
+            template_tree.write(tf)
+            tf.seek(0)
+            drawing = svg2rlg(tf)
+
+        page_pdf = BytesIO()
+        page_output = Canvas(page_pdf, pagesize=(drawing.width, drawing.height))
+        renderPDF.draw(drawing, page_output, 0, 0)
+        page_output.showPage()
+        page_output.save()
+        page_pdf.seek(0)
+        return page_pdf
+
+    def _template_name(self, idx: int):
+        """Get the template name of the page at the given index"""
+        if idx < len(self.pagedata) and self.pagedata[idx]:
+            return self.pagedata[idx]
+        return "Blank"
 
-        for idx, page_id in enumerate(self.page_ids):
-            pg_rm_fp = os.path.join(self.pages_fp, f"{page_id}{os.extsep}rm")
-            if not os.path.isfile(pg_rm_fp):
-                self._log.debug(f"skipping {pg_rm_fp}")
-                continue
+    @staticmethod
+    def _load_template(templates_fp: str, template_name: str, log: logging.Logger):
+        """Get the svg template tree with the given name from the templates
+        directory, or the transparent overlay template if the name is None
+        """
+        if template_name is None:
+            return ConvertRM._overlay_template()
+        template_svg_fp = os.path.join(templates_fp, f"{template_name}{os.extsep}svg")
+
+        ET.register_namespace("", "http://www.w3.org/2000/svg")
+        template_tree = ConvertRM._blank_template()
+
+        if template_name == "Blank":
+            log.debug("overriding Blank template with clean svg root")
+        elif os.path.isfile(template_svg_fp):
+            template_tree = ET.parse(template_svg_fp)
+        else:
+            log.warning("template %s not found at %s", template_name, template_svg_fp)
+        return template_tree
 
-            template_filename = self.pagedata[idx]
-            template_svg_fp = os.path.join(
-                self.templates_fp, f"{template_filename}{os.extsep}svg"
+    @staticmethod
+    def _overlay_transformation(pdf_page, landscape=False):
+        """Map the reMarkable screen coordinates onto the original PDF page.
+        The tablet shows the page cropbox as the page /Rotate displays it, fit to
+        the screen, centered horizontally and aligned to the top. Landscape
+        documents are read with the tablet turned a quarter turn counterclockwise.
+        """
+        box = pdf_page.cropbox
+        rotation = pdf_page.rotation % 360
+        view_width, view_height = float(box.width), float(box.height)
+        if rotation in (90, 270):
+            view_width, view_height = view_height, view_width
+
+        # overlay page into the screen as seen by the user
+        transformation = Transformation()
+        screen_width, screen_height = ConvertRM.X_SIZE, ConvertRM.Y_SIZE
+        if landscape:
+            screen_width, screen_height = screen_height, screen_width
+            transformation = transformation.rotate(90).translate(screen_width, 0)
+
+        # fit the screen into the displayed page
+        scale = max(view_width / screen_width, view_height / screen_height)
+        transformation = transformation.scale(scale, scale).translate(
+            (view_width - screen_width * scale) / 2, view_height - screen_height * scale
+        )
+
+        # undo the display rotation, back into the page user space
+        if rotation:
+            corners = [
+                Transformation().rotate(rotation).apply_on(corner)
+                for corner in ((0, 0), (view_width, view_height))
+            ]
+            transformation = transformation.rotate(rotation).translate(
+                -min(x for x, _ in corners), -min(y for _, y in corners)
             )
+        return transformation.translate(float(box.left), float(box.bottom))
+
+    def _page_rm_fp(self, page_id):
+        return os.path.join(self.pages_fp, f"{page_id}{os.extsep}rm")
 
-            ET.register_namespace("", "http://www.w3.org/2000/svg")
-            template_tree = ConvertRM._blank_template()
+    def _page_args(self, idx: int, overlay: bool):
+        """Get the _render_page_worker arguments of the page at the given index"""
+        template_name = None if overlay else self._template_name(idx)
+        return self._page_rm_fp(self.page_ids[idx]), self.templates_fp, template_name
+
+    def _render_page(self, idx: int, overlay: bool):
+        """Render the page at the given index into a single page PDF, either on its
+        template or as a transparent overlay for the original PDF page
+        """
+        pg_rm_fp, templates_fp, template_name = self._page_args(idx, overlay)
+        template_tree = ConvertRM._load_template(templates_fp, template_name, self._log)
+        return ConvertRM._render_page_pdf(pg_rm_fp, template_tree, self._log)
+
+    def _rendered_pages(self, pages, executor: Executor = None):
+        """Render the (page index, overlay) pages, yielding the single page PDFs in
+        order. With an executor, the pages render in its worker processes.
+        """
+        if executor is None:
+            for idx, overlay in pages:
+                yield self._render_page(idx, overlay)
+            return
+
+        pending = deque()
+        for idx, overlay in pages:
+            if len(pending) >= ConvertRM.PAGE_WINDOW:
+                yield BytesIO(pending.popleft().result())
+            pending.append(
+                executor.submit(_render_page_worker, *self._page_args(idx, overlay))
+            )
+        while pending:
+            yield BytesIO(pending.popleft().result())
 
-            if template_filename == "Blank":
-                self._log.debug("overriding Blank template with clean svg root")
-            elif os.path.isfile(template_svg_fp):
-                template_tree = ET.parse(template_svg_fp)
-            else:
-                self._log.warning(
-                    "template %s not found at %s", template_filename, template_svg_fp
+    def _convert_annotated_pdf(
+        self, pdf_output_path: os.PathLike, creator: str, executor: Executor = None
+    ):
+        """Overlay the annotation layers onto the pages of the original PDF.
+        The original page content is kept as is, not re-rasterized.
+        """
+        reader = PdfReader(self.pdf_fp)
+        writer = PdfWriter()
+
+        # unopened documents have no page ids, keep the original pages as is
+        page_ids = self.page_ids or [None] * len(reader.pages)
+        # newer firmware supports inserting notebook pages into a PDF
+        redirection = self.content.get("redirectionPageMap") or list(
+            range(len(page_ids))
+        )
+
+        # (page index, original page index or None, has annotations) of each page
+        layout = []
+        for idx, page_id in enumerate(page_ids):
+            pdf_idx = redirection[idx] if idx < len(redirection) else idx
+            if pdf_idx < 0 or pdf_idx >= len(reader.pages):
+                # page inserted on the tablet, rendered as a notebook page
+                pdf_idx = None
+            has_annotations = page_id is not None and os.path.isfile(
+                self._page_rm_fp(page_id)
+            )
+            if pdf_idx is None and not has_annotations:
+                self._log.debug(f"skipping {self._page_rm_fp(page_id)}")
+                continue
+            layout.append((idx, pdf_idx, has_annotations))
+
+        rendered = self._rendered_pages(
+            [
+                (idx, pdf_idx is not None)
+                for idx, pdf_idx, has_annotations in layout
+                if has_annotations
+            ],
+            executor,
+        )
+        for idx, pdf_idx, has_annotations in layout:
+            if pdf_idx is None:
+                writer.add_page(PdfReader(next(rendered)).pages[0])
+                continue
+
+            page = writer.add_page(reader.pages[pdf_idx])
+            if has_annotations:
+                page.merge_transformed_page(
+                    PdfReader(next(rendered)).pages[0],
+                    ConvertRM._overlay_transformation(
+                        page, self.content.get("orientation") == "landscape"
+                    ),
                 )
 
-            with open(pg_rm_fp, "rb") as fh:
-                template_tree = self._convert_rm_to_svg(fh, template_tree)
+        writer.add_metadata(self._document_info(creator))
+        with _open_output(pdf_output_path) as fh:
+            writer.write(fh)
+
+    def _document_info(self, creator: str):
+        title = self.metadata.get("visibleName", "Untitled")
+        return {
+            "/Subject": title,
+            "/Title": f"{title}{os.extsep}pdf",
+            "/Creator": creator,
+        }
+
+    def convert_document(
+        self,
+        pdf_output_path: os.PathLike,
+        creator="awwong1/remarkable-cli",
+        executor: Executor = None,
+    ):
+        """Render the document pages into a PDF.
+        Notebook pages are rendered one at a time and streamed to the output file,
+        so memory use is bounded by the largest page, not by the page count.
+        If a process pool executor is given, pages render in parallel in its
+        workers and are merged in page order.
+        """
+        if os.path.isfile(self.pdf_fp):
+            return self._convert_annotated_pdf(pdf_output_path, creator, executor)
 
-            with TemporaryFile(mode="w+b") as tf:
-                template_tree.write(tf)
-                tf.seek(0)
-                drawing = svg2rlg(tf)
-                pdf_output.setPageSize((drawing.width, drawing.height))
-            renderPDF.draw(drawing, pdf_output, 0, 0)
-            pdf_output.showPage()
+        pages = []
+        for idx, page_id in enumerate(self.page_ids):
+            pg_rm_fp = self._page_rm_fp(page_id)
+            if not os.path.isfile(pg_rm_fp):
+                self._log.debug(f"skipping {pg_rm_fp}")
+                continue
+            pages.append((idx, False))
 
-        pdf_output.save()
+        with _open_output(pdf_output_path) as fh:
+            pdf_output = PDFStreamWriter(fh)
+            for page_pdf in self._rendered_pages(pages, executor):
+                pdf_output.add_pages(PdfReader(page_pdf))
+            pdf_output.close(info=self._document_info(creator))
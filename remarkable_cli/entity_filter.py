@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import os
+from fnmatch import fnmatchcase
+
+
+class EntityFilter:
+    """Select xochitl entities by visible path, name, uuid or document type.
+
+    Patterns are shell-style globs, optionally prefixed with the field to match:
+    - path:<glob> (default), the entity path or any of its parent folder paths
+    - name:<glob>, the entity visible name
+    - uuid:<glob>, the entity uuid
+    - type:<glob>, one of notebook, pdf, epub or folder
+    """
+
+    FIELDS = ("path", "name", "uuid", "type")
+
+    def __init__(self, include=(), exclude=()):
+        self.include = [EntityFilter._parse(pattern) for pattern in include]
+        self.exclude = [EntityFilter._parse(pattern) for pattern in exclude]
+
+    @staticmethod
+    def _parse(pattern: str):
+        field, sep, glob = pattern.partition(":")
+        if sep and field in EntityFilter.FIELDS:
+            return field, glob
+        return "path", pattern
+
+    @property
+    def active(self):
+        """True if any include or exclude patterns are set"""
+        return bool(self.include or self.exclude)
+
+    @property
+    def needs_content(self):
+        """True if the patterns need the entity .content to determine the type"""
+        return any(field == "type" for field, _ in self.include + self.exclude)
+
+    @staticmethod
+    def entity_type(meta: dict, content: dict = None):
+        """Get the entity type (notebook, pdf, epub, folder)"""
+        if meta.get("type") == "CollectionType":
+            return "folder"
+        return (content or {}).get("fileType") or "notebook"
+
+    @staticmethod
+    def _match_one(field, glob, meta_id, meta, path, content):
+        if field == "uuid":
+            return fnmatchcase(meta_id, glob)
+        if field == "name":
+            return fnmatchcase(meta.get("visibleName", ""), glob)
+        if field == "type":
+            return fnmatchcase(EntityFilter.entity_type(meta, content), glob)
+
+        # path pattern, a matching folder also selects all of its descendants
+        parts = path.strip(os.sep).split(os.sep)
+        return any(
+            fnmatchcase(os.sep.join(parts[: idx + 1]), glob.strip(os.sep))
+            for idx in range(len(parts))
+        )
+
+    def matches(self, meta_id: str, meta: dict, path: str, content: dict = None):
+        """Check if the entity is selected by the include and exclude patterns.
+        path is the entity path, as resolved by Client._get_path
+        """
+        if self.include and not any(
+            EntityFilter._match_one(field, glob, meta_id, meta, path, content)
+            for field, glob in self.include
+        ):
+            return False
+        return not any(
+            EntityFilter._match_one(field, glob, meta_id, meta, path, content)
+            for field, glob in self.exclude
+        )
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+
+from .client import Client
+
+
+class _DeviceLogAdapter(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        return f"[{self.extra['device']}] {msg}", kwargs
+
+
+class Fleet:
+    """Run the actions for every device in the config file concurrently.
+
+    The config file is INI formatted, with one section per device. Keys are the
+    CLI option names (destination, port, username, password, backup-dir, ...),
+    unset keys fall back to the [DEFAULT] section, then to the CLI arguments.
+    The backup directory defaults to a sub directory named after the device.
+    Repeatable options (action, include, exclude, push-path) take one value per line.
+    The render workers (jobs) and max-transfers are shared by the whole fleet, they
+    are only set on the command line.
+    """
+
+    LIST_OPTIONS = ("action", "include", "exclude", "push_path")
+    # shared by all devices, only set on the command line
+    FLEET_OPTIONS = ("devices", "jobs", "max_transfers", "agent_serve")
+
+    def __init__(self, args: Namespace, parser: ArgumentParser):
+        self.args = args
+        self._log = logging.getLogger(__name__)
+        self.devices = Fleet.load_devices(args.devices, args, parser)
+
+    @staticmethod
+    def _option_value(section, key: str, action):
+        """Convert the config value with the type of the parser action"""
+        if action.nargs == 0:
+            # flags, store_true and store_false take a boolean, count an integer
+            if action.const is None:
+                return section.getint(key)
+            return section.getboolean(key)
+
+        if action.dest in Fleet.LIST_OPTIONS:
+            values = [
+                line.strip() for line in section.get(key).splitlines() if line.strip()
+            ]
+        else:
+            values = [section.get(key)]
+        if action.type is not None:
+            values = [action.type(value) for value in values]
+        for value in values:
+            if action.choices is not None and value not in action.choices:
+                raise ValueError(f"invalid {key} {value}, choose from {action.choices}")
+        return values if action.dest in Fleet.LIST_OPTIONS else values[0]
+
+    @staticmethod
+    def load_devices(config_fp: str, defaults: Namespace, parser: ArgumentParser):
+        """Read the device arguments, keyed by device name, from the config file.
+        Values are converted with the types of the parser options.
+        """
+        config = ConfigParser()
+        with open(config_fp, "r") as fh:
+            config.read_file(fh)
+
+        actions = {action.dest: action for action in parser._actions}
+        devices = {}
+        for name in config.sections():
+            device_args = Namespace(**vars(defaults))
+            device_args.devices = None
+            device_args.backup_dir = os.path.join(defaults.backup_dir, name)
+
+            section = config[name]
+            for key in section:
+                dest = key.replace("-", "_")
+                if dest in Fleet.FLEET_OPTIONS:
+                    raise ValueError(
+                        f"{key} applies to the whole fleet, "
+                        + f"set it on the command line, not for device {name}"
+                    )
+                if dest not in actions or not hasattr(defaults, dest):
+                    raise ValueError(f"unknown option {key} for device {name}")
+                try:
+                    value = Fleet._option_value(section, key, actions[dest])
+                except ValueError as e:
+                    raise ValueError(f"device {name}: {e}") from e
+                setattr(device_args, dest, value)
+
+            device_args.backup_dir = os.path.expanduser(device_args.backup_dir)
+            devices[name] = device_args
+        return devices
+
+    def _run_device(self, name, device_args, render_executor, transfer_slots):
+        logger = _DeviceLogAdapter(self._log, {"device": name})
+        start = time.monotonic()
+        client = None
+        try:
+            client = Client(
+                device_args,
+                logger=logger,
+                render_executor=render_executor,
+                transfer_slots=transfer_slots,
+            )
+            client.run_actions()
+            status = "ok"
+        except Exception as e:
+            logger.exception("actions failed")
+            status = f"failed: {e}"
+        finally:
+            if client is not None:
+                client.close()
+        stats = client.stats if client is not None else {}
+        return status, stats, time.monotonic() - start
+
+    def run(self):
+        """Run the actions on all devices, then log a per device summary"""
+        transfer_slots = threading.BoundedSemaphore(max(1, self.args.max_transfers))
+        results = {}
+        with Client.render_process_pool(self.args.jobs) as renderer:
+            with ThreadPoolExecutor(max_workers=max(1, len(self.devices))) as runner:
+                futures = {
+                    name: runner.submit(
+                        self._run_device, name, device_args, renderer, transfer_slots
+                    )
+                    for name, device_args in self.devices.items()
+                }
+                for name, future in futures.items():
+                    results[name] = future.result()
+
+        self._log.info("summary for %d devices", len(results))
+        for name, (status, stats, elapsed) in results.items():
+            self._log.info(
+                "%s: %s, pulled %d files, rendered %d documents, "
+                + "pushed %d files in %.1fs",
+                name,
+                status,
+                stats.get("pulled", 0),
+                stats.get("rendered", 0),
+                stats.get("pushed", 0),
+                elapsed,
+            )
+        return results
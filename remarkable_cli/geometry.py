@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from math import cos, hypot, pi, sin
+
+
+def _unit(dx, dy):
+    length = hypot(dx, dy)
+    if length == 0:
+        return None
+    return dx / length, dy / length
+
+
+def _cap(center, tangent, radius, segments, stroke_cap, forward):
+    """Points of the cap joining the two sides of the outline at a stroke end.
+    Forward caps run from the left side to the right side around the tangent,
+    backward caps from the right side to the left side.
+    """
+    (x, y), (tx, ty) = center, tangent
+    nx, ny = -ty, tx
+    if not forward:
+        tx, ty, nx, ny = -tx, -ty, -nx, -ny
+
+    if stroke_cap == "square":
+        return [
+            (x + (nx + tx) * radius, y + (ny + ty) * radius),
+            (x + (tx - nx) * radius, y + (ty - ny) * radius),
+        ]
+    if stroke_cap != "round":
+        return []
+
+    points = []
+    for idx in range(1, segments):
+        angle = pi * idx / segments
+        points.append(
+            (
+                x + (nx * cos(angle) + tx * sin(angle)) * radius,
+                y + (ny * cos(angle) + ty * sin(angle)) * radius,
+            )
+        )
+    return points
+
+
+def stroke_outline(points, widths, stroke_cap="round", cap_segments=6):
+    """Get the filled outline polygon of a stroke with a width at every point.
+
+    points is a list of (x, y) tuples and widths the stroke width at each point.
+    The polygon runs along the left side of the stroke, around the end cap,
+    back along the right side and around the start cap.
+    """
+    # drop repeated points, keeping the widest width
+    centers, radii = [], []
+    for point, width in zip(points, widths):
+        if centers and centers[-1] == point:
+            radii[-1] = max(radii[-1], width / 2.0)
+            continue
+        centers.append(point)
+        radii.append(width / 2.0)
+
+    if not centers:
+        return []
+    if len(centers) == 1:
+        # a dot, approximated with a polygon
+        (x, y), radius = centers[0], radii[0]
+        segments = 2 * cap_segments
+        return [
+            (
+                x + cos(2 * pi * idx / segments) * radius,
+                y + sin(2 * pi * idx / segments) * radius,
+            )
+            for idx in range(segments)
+        ]
+
+    tangents = []
+    for idx in range(len(centers)):
+        x0, y0 = centers[max(idx - 1, 0)]
+        x1, y1 = centers[min(idx + 1, len(centers) - 1)]
+        tangent = _unit(x1 - x0, y1 - y0)
+        if tangent is None:
+            tangent = tangents[-1] if tangents else (1.0, 0.0)
+        tangents.append(tangent)
+
+    left, right = [], []
+    for (x, y), (tx, ty), radius in zip(centers, tangents, radii):
+        nx, ny = -ty, tx
+        left.append((x + nx * radius, y + ny * radius))
+        right.append((x - nx * radius, y - ny * radius))
+
+    outline = list(left)
+    outline += _cap(
+        centers[-1], tangents[-1], radii[-1], cap_segments, stroke_cap, True
+    )
+    outline += reversed(right)
+    outline += _cap(centers[0], tangents[0], radii[0], cap_segments, stroke_cap, False)
+    return outline
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+
+from pypdf import PdfReader
+from pypdf.generic import (
+    ArrayObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NumberObject,
+    PdfObject,
+    create_string_object,
+)
+
+
+class PDFStreamWriter:
+    """Concatenate PDF pages into an output file, writing each page as it is added.
+    Only the object offsets are kept in memory, so peak memory depends on the
+    largest added page rather than the number of pages.
+    """
+
+    HEADER = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+    CATALOG_ID = 1
+    PAGES_ID = 2
+
+    def __init__(self, fh):
+        self._fh = fh
+        self._offsets = {}
+        self._next_id = PDFStreamWriter.PAGES_ID + 1
+        self._page_ids = []
+        self._fh.write(PDFStreamWriter.HEADER)
+
+    def _allocate(self):
+        obj_id = self._next_id
+        self._next_id += 1
+        return obj_id
+
+    def _write_object(self, obj_id: int, obj: PdfObject):
+        self._offsets[obj_id] = self._fh.tell()
+        self._fh.write(f"{obj_id} 0 obj\n".encode("ascii"))
+        obj.write_to_stream(self._fh)
+        self._fh.write(b"\nendobj\n")
+
+    def add_page(self, page):
+        """Write the page and all of the objects it references to the output"""
+        ids = {}
+        pending = deque()
+
+        def reference(ref: IndirectObject):
+            key = (ref.idnum, ref.generation)
+            if key not in ids:
+                ids[key] = self._allocate()
+                pending.append((ids[key], ref.get_object()))
+            return IndirectObject(ids[key], 0, None)
+
+        def remap(obj):
+            # the source reader is discarded afterwards, so objects are updated in place
+            if isinstance(obj, IndirectObject):
+                return reference(obj)
+            if isinstance(obj, DictionaryObject):
+                for key, value in list(obj.items()):
+                    obj[key] = remap(value)
+            elif isinstance(obj, ArrayObject):
+                for idx, value in enumerate(obj):
+                    obj[idx] = remap(value)
+            return obj
+
+        page_id = self._allocate()
+        if page.indirect_reference is not None:
+            ref = page.indirect_reference
+            ids[(ref.idnum, ref.generation)] = page_id
+
+        # the page tree of the source document is not copied
+        if "/Parent" in page:
+            del page["/Parent"]
+        remap(page)
+        page[NameObject("/Parent")] = IndirectObject(PDFStreamWriter.PAGES_ID, 0, None)
+        self._write_object(page_id, page)
+        self._page_ids.append(page_id)
+
+        while pending:
+            obj_id, obj = pending.popleft()
+            self._write_object(obj_id, remap(obj))
+
+    def add_pages(self, reader: PdfReader):
+        """Write all of the pages of the source document to the output"""
+        for page in reader.pages:
+            self.add_page(page)
+
+    def close(self, info: dict = None):
+        """Write the page tree, document info and cross reference table"""
+        kids = [IndirectObject(page_id, 0, None) for page_id in self._page_ids]
+        pages = DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Pages"),
+                NameObject("/Kids"): ArrayObject(kids),
+                NameObject("/Count"): NumberObject(len(kids)),
+            }
+        )
+        self._write_object(PDFStreamWriter.PAGES_ID, pages)
+
+        catalog = DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Catalog"),
+                NameObject("/Pages"): IndirectObject(PDFStreamWriter.PAGES_ID, 0, None),
+            }
+        )
+        self._write_object(PDFStreamWriter.CATALOG_ID, catalog)
+
+        trailer = DictionaryObject(
+            {
+                NameObject("/Root"): IndirectObject(
+                    PDFStreamWriter.CATALOG_ID, 0, None
+                ),
+            }
+        )
+        if info:
+            info_id = self._allocate()
+            self._write_object(
+                info_id,
+                DictionaryObject(
+                    {
+                        NameObject(key): create_string_object(value)
+                        for key, value in info.items()
+                    }
+                ),
+            )
+            trailer[NameObject("/Info")] = IndirectObject(info_id, 0, None)
+        trailer[NameObject("/Size")] = NumberObject(self._next_id)
+
+        xref_offset = self._fh.tell()
+        self._fh.write(f"xref\n0 {self._next_id}\n".encode("ascii"))
+        self._fh.write(b"0000000000 65535 f \n")
+        for obj_id in range(1, self._next_id):
+            offset = self._offsets.get(obj_id)
+            if offset is None:
+                self._fh.write(b"0000000000 00000 f \n")
+            else:
+                self._fh.write(f"{offset:010d} 00000 n \n".encode("ascii"))
+        self._fh.write(b"trailer\n")
+        trailer.write_to_stream(self._fh)
+        self._fh.write(f"\nstartxref\n{xref_offset}\n%%EOF\n".encode("ascii"))
@@ -4,7 +4,6 @@ class Pen:
         name="Basic Pen",
         base_width=2.0,
         stroke_color="black",
-        segment_length=-1,
         opacity=1.0,
         stroke_cap="round",
         stroke_join="round",
@@ -13,17 +12,23 @@ class Pen:
         self.color = stroke_color
         self.base_width = base_width  # Small: 1.875; Medium 2.0; Large 2.125
         self.opacity = opacity
-        self.segment_length = segment_length
         self.stroke_cap = stroke_cap
         self.stroke_join = stroke_join
 
-    def get_polyline_attributes(self, _speed, _tilt, width, _pressure):
-        segment_width = (self.base_width * width) / 2.0
+    def get_segment_width(self, _speed, _tilt, width, _pressure):
+        return (self.base_width * width) / 2.0
+
+    def get_segment_opacity(self, _speed, _tilt, _width, _pressure):
+        return self.opacity
+
+    def get_polyline_attributes(self, speed, tilt, width, pressure):
+        segment_width = self.get_segment_width(speed, tilt, width, pressure)
+        segment_opacity = self.get_segment_opacity(speed, tilt, width, pressure)
         return {
             "fill": "none",
             "stroke-width": f"{segment_width:.3f}",
             "stroke": self.color,
-            "stroke-opacity": f"{self.opacity:.3f}",
+            "stroke-opacity": f"{segment_opacity:.3f}",
             "stroke-linecap": self.stroke_cap,
             "stroke-linejoin": self.stroke_join,
         }
@@ -35,18 +40,10 @@ class Ballpoint(Pen):
             name="Ballpoint",
             base_width=base_width,
             stroke_color=stroke_color,
-            segment_length=5,
         )
 
-    def get_polyline_attributes(self, speed, tilt, width, pressure):
-        attrs = super().get_polyline_attributes(speed, tilt, width, pressure)
-        segment_width = (0.5 + pressure) + (1 * width) - 0.5 * (speed / 50)
-        attrs.update(
-            {
-                "stroke-width": f"{segment_width:.3f}",
-            }
-        )
-        return attrs
+    def get_segment_width(self, speed, tilt, width, pressure):
+        return (0.5 + pressure) + (1 * width) - 0.5 * (speed / 50)
 
 
 class Fineliner(Pen):
@@ -56,15 +53,8 @@ class Fineliner(Pen):
             stroke_color=stroke_color,
         )
 
-    def get_polyline_attributes(self, speed, tilt, width, pressure):
-        attrs = super().get_polyline_attributes(speed, tilt, width, pressure)
-        segment_width = width
-        attrs.update(
-            {
-                "stroke-width": f"{segment_width:.3f}",
-            }
-        )
-        return attrs
+    def get_segment_width(self, speed, tilt, width, pressure):
+        return width
 
 
 class Marker(Pen):
@@ -72,19 +62,11 @@ class Marker(Pen):
         super().__init__(
             name="Marker",
             base_width=base_width,
-            segment_length=3,
             stroke_color=stroke_color,
         )
 
-    def get_polyline_attributes(self, speed, tilt, width, pressure):
-        attrs = super().get_polyline_attributes(speed, tilt, width, pressure)
-        segment_width = (width * self.base_width) / 2.7
-        attrs.update(
-            {
-                "stroke-width": f"{segment_width:.3f}",
-            }
-        )
-        return attrs
+    def get_segment_width(self, speed, tilt, width, pressure):
+        return (width * self.base_width) / 2.7
 
 
 class Pencil(Pen):
@@ -92,40 +74,23 @@ class Pencil(Pen):
         super().__init__(
             name="Pencil",
             base_width=stroke_width,
-            segment_length=2,
             # stroke_join="bevel",
         )
 
-    def get_polyline_attributes(self, speed, tilt, width, pressure):
-        attrs = super().get_polyline_attributes(speed, tilt, width, pressure)
-        segment_width = (width * self.base_width) / 3.5
+    def get_segment_width(self, speed, tilt, width, pressure):
+        return (width * self.base_width) / 3.5
 
+    def get_segment_opacity(self, speed, tilt, width, pressure):
         segment_opacity = (0.1 * -(speed / 35)) + (1 * pressure)
-        segment_opacity = min(max(0.0, segment_opacity), 1.0) - 0.1
-
-        attrs.update(
-            {
-                "stroke-width": f"{segment_width:.3f}",
-                "stroke-opacity": f"{segment_opacity:.3f}",
-            }
-        )
-        return attrs
+        return min(max(0.0, segment_opacity), 1.0) - 0.1
 
 
 class MechanicalPencil(Pen):
     def __init__(self, stroke_width):
         super().__init__(name="Mechanical Pencil", base_width=stroke_width)
 
-    def get_polyline_attributes(self, speed, tilt, width, pressure):
-        attrs = super().get_polyline_attributes(speed, tilt, width, pressure)
-        segment_width = (width * self.base_width) / 3.5
-
-        attrs.update(
-            {
-                "stroke-width": f"{segment_width:.3f}",
-            }
-        )
-        return attrs
+    def get_segment_width(self, speed, tilt, width, pressure):
+        return (width * self.base_width) / 3.5
 
 
 class Brush(Pen):
@@ -134,22 +99,14 @@ class Brush(Pen):
             name="Brush",
             base_width=base_width,
             stroke_color=stroke_color,
-            segment_length=4,
         )
 
-    def get_polyline_attributes(self, speed, tilt, width, pressure):
-        attrs = super().get_polyline_attributes(speed, tilt, width, pressure)
-        segment_width = (width * self.base_width) / 2.7
+    def get_segment_width(self, speed, tilt, width, pressure):
+        return (width * self.base_width) / 2.7
 
+    def get_segment_opacity(self, speed, tilt, width, pressure):
         intensity = (pressure ** 1.5 - 0.2 * (speed / 50)) * 1.5
-        intensity = min(max(0.0, intensity), 1.0)
-        attrs.update(
-            {
-                "stroke-width": f"{segment_width:.3f}",
-                "stroke-opacity": f"{intensity:.3f}",
-            }
-        )
-        return attrs
+        return min(max(0.0, intensity), 1.0)
 
 
 class Highlighter(Pen):
@@ -184,5 +141,4 @@ class Calligraphy(Pen):
             name="Calligraphy",
             base_width=base_width,
             stroke_color=stroke_color,
-            segment_length=2,
         )
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+import time
+
+import paramiko
+
+# ciphers tried by the auto-tune probe, in addition to toggling compression
+CIPHER_CANDIDATES = ("aes128-ctr", "aes256-ctr", "aes128-gcm@openssh.com")
+# channel window and packet sizes tried with the fastest cipher, in bytes
+WINDOW_SIZE_CANDIDATES = (1 << 21, 1 << 23)
+MAX_PACKET_SIZE_CANDIDATES = (1 << 15, 1 << 16)
+
+
+def supported_ciphers():
+    """Get the ciphers the installed paramiko can negotiate, in preference order"""
+    return tuple(paramiko.Transport._preferred_ciphers)
+
+
+def parse_ciphers(ciphers: str):
+    """Split the comma separated cipher names, None if there are none"""
+    names = [name.strip() for name in (ciphers or "").split(",") if name.strip()]
+    return names or None
+
+
+def connect_ssh(
+    hostname: str,
+    port: int,
+    username: str,
+    password: str,
+    compress=False,
+    ciphers=None,
+    window_size=None,
+    max_packet_size=None,
+    timeout=5.0,
+):
+    """Open a paramiko SSH connection with the given transport settings.
+    ciphers restricts the negotiation to the listed cipher names, window_size and
+    max_packet_size apply to all channels (sftp, exec) opened on the connection.
+    """
+    disabled_algorithms = None
+    if ciphers:
+        supported = supported_ciphers()
+        if not any(cipher in supported for cipher in ciphers):
+            raise ValueError(f"no supported cipher in {', '.join(ciphers)}")
+        disabled_algorithms = {
+            "ciphers": [cipher for cipher in supported if cipher not in ciphers]
+        }
+
+    ssh_client = paramiko.SSHClient()
+    ssh_client.load_system_host_keys()
+    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh_client.connect(
+        hostname=hostname,
+        username=username,
+        port=port,
+        password=password,
+        timeout=timeout,
+        compress=compress,
+        disabled_algorithms=disabled_algorithms,
+    )
+
+    transport = ssh_client.get_transport()
+    if window_size:
+        transport.default_window_size = window_size
+    if max_packet_size:
+        transport.default_max_packet_size = max_packet_size
+    return ssh_client
+
+
+class TuningCache:
+    """JSON file of the auto-tuned transport settings, keyed by destination"""
+
+    MAX_AGE = 7 * 24 * 60 * 60
+    _lock = threading.Lock()
+
+    def __init__(self, cache_fp: str):
+        self.cache_fp = cache_fp
+
+    @staticmethod
+    def default_path():
+        cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+            os.path.expanduser("~"), ".cache"
+        )
+        return os.path.join(cache_dir, "remarkable-cli", "transport.json")
+
+    def _load(self):
+        try:
+            with open(self.cache_fp, "r") as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, destination: str):
+        """Get the cached settings for the destination, None if absent or expired"""
+        entry = self._load().get(destination)
+        if entry is None or time.time() - entry.get("tuned", 0) > TuningCache.MAX_AGE:
+            return None
+        return entry.get("settings")
+
+    def put(self, destination: str, settings: dict):
+        with TuningCache._lock:
+            entries = self._load()
+            entries[destination] = {"tuned": time.time(), "settings": settings}
+            os.makedirs(os.path.dirname(self.cache_fp), exist_ok=True)
+            tmp_fp = f"{self.cache_fp}.{os.getpid()}.tmp"
+            with open(tmp_fp, "w") as fh:
+                json.dump(entries, fh, indent=2)
+            os.replace(tmp_fp, self.cache_fp)
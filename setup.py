@@ -23,5 +23,6 @@ setup(
         "Programming Language :: Python :: 3 :: Only",
     ],
     entry_points={"console_scripts": ["remarkable-cli=remarkable_cli:main"]},
-    install_requires=["paramiko", "requests", "svglib", "reportlab"],
+    install_requires=["paramiko", "requests", "svglib", "reportlab", "pypdf"],
+    extras_require={"columnar": ["numpy"]},
 )
@@ -0,0 +1,71 @@
+import logging
+import os
+import threading
+import unittest
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from remarkable_cli.agent import Agent, AgentConnection
+
+
+class TestAgent(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        logging.disable(logging.CRITICAL)
+        return super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        logging.disable(logging.NOTSET)
+        return super().tearDownClass()
+
+    def setUp(self):
+        # unix socket paths are short, keep out of nested temporary directories
+        self.tmp_dir = TemporaryDirectory(dir="/tmp")
+        self.socket_path = os.path.join(self.tmp_dir.name, "agent.sock")
+        self.remote_fh = mock.MagicMock()
+        self.remote_fh.read.side_effect = lambda size: b"x" * size
+        self.remote_fh.tell.return_value = 0
+        self.ssh_client = mock.MagicMock()
+        self.ssh_client.open_sftp.return_value.open.return_value = self.remote_fh
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_single_agent_per_socket(self):
+        agent = Agent(self.ssh_client, self.socket_path)
+        with self.assertRaises(FileExistsError):
+            Agent(self.ssh_client, self.socket_path)
+        # the live agent socket is kept
+        self.assertTrue(os.path.exists(self.socket_path))
+
+        agent.idle_timeout = 0
+        agent.serve_until_idle()
+        self.assertFalse(os.path.exists(self.socket_path))
+        Agent(self.ssh_client, self.socket_path).server_close()
+
+    def test_read_prefetches(self):
+        agent = Agent(self.ssh_client, self.socket_path, idle_timeout=0.2)
+        server = threading.Thread(target=agent.serve_until_idle)
+        server.start()
+        try:
+            connection = AgentConnection(self.socket_path)
+            try:
+                sftp = connection.open_sftp()
+                with sftp.open("/remote/file.rm", "rb") as remote_fh:
+                    self.assertEqual(remote_fh.read(4), b"xxxx")
+                    self.remote_fh.tell.return_value = 4
+                    self.assertEqual(remote_fh.read(4), b"xxxx")
+                    with self.assertRaises(ValueError):
+                        remote_fh.seek(0, os.SEEK_END)
+                with self.assertRaises(IOError):
+                    sftp.open("/remote/file.rm", "wb")
+            finally:
+                connection.close()
+        finally:
+            server.join()
+
+        # one open and prefetch for the sequential reads of the file
+        self.ssh_client.open_sftp.return_value.open.assert_called_once()
+        self.remote_fh.prefetch.assert_called_once_with()
+        self.remote_fh.seek.assert_called_once_with(0)
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+
+from remarkable_cli.backup_index import BackupIndex
+
+
+class TestBackupIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.index = BackupIndex(os.path.join(self.tmp_dir.name, "index.sqlite3"))
+        entity = {"page_count": None, "last_modified": 0, "templates": []}
+        self.index.replace_entities(
+            [
+                dict(
+                    entity,
+                    uuid="f0",
+                    name="Work",
+                    path="Work",
+                    parent="",
+                    type="folder",
+                ),
+                dict(
+                    entity,
+                    uuid="d1",
+                    name="Notes",
+                    path=os.path.join("Work", "Notes"),
+                    parent="f0",
+                    type="notebook",
+                    page_count=3,
+                    templates=["Blank", "Lined", "Blank"],
+                ),
+                dict(
+                    entity,
+                    uuid="d2",
+                    name="Old",
+                    path=os.path.join("trash", "Old"),
+                    parent="trash",
+                    type="pdf",
+                ),
+            ]
+        )
+
+    def tearDown(self):
+        self.index.close()
+        self.tmp_dir.cleanup()
+
+    def test_list_folder(self):
+        self.assertEqual([e["uuid"] for e in self.index.list_folder()], ["f0"])
+        self.assertEqual([e["uuid"] for e in self.index.list_folder("Work")], ["d1"])
+        self.assertEqual([e["uuid"] for e in self.index.list_folder("trash")], ["d2"])
+        self.assertIsNone(self.index.list_folder(os.path.join("Work", "Notes")))
+        self.assertIsNone(self.index.list_folder("Personal"))
+
+    def test_find_and_lookup(self):
+        self.assertEqual([e["uuid"] for e in self.index.find("No*")], ["d1"])
+        self.assertEqual([e["uuid"] for e in self.index.find("Work*")], ["f0", "d1"])
+        self.assertEqual(self.index.lookup("d1")["name"], "Notes")
+        self.assertEqual(self.index.lookup(os.path.join("Work", "Notes"))["uuid"], "d1")
+        self.assertIsNone(self.index.lookup("Notes"))
+        self.assertEqual(
+            [tuple(row) for row in self.index.templates("d1")],
+            [("Blank", 2), ("Lined", 1)],
+        )
+
+    def test_replace(self):
+        self.assertEqual(self.index.replace_entities([]), 0)
+        self.assertEqual(self.index.find("*"), [])
+        self.assertEqual(self.index.templates("d1"), [])
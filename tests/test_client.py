@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import shutil
+import unittest
+from argparse import Namespace
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from pypdf import PdfWriter
+
+from remarkable_cli.client import Client
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+ENTITY_ID = "07a07495-09b1-47f9-bb88-370aadc4395b"
+
+
+class TestClientOutputs(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        logging.disable(logging.CRITICAL)
+        return super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        logging.disable(logging.NOTSET)
+        return super().tearDownClass()
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.client = Client(
+            Namespace(
+                log_level=0,
+                backup_dir=self.tmp_dir.name,
+                include=None,
+                exclude=None,
+                format="pdf",
+                jobs=1,
+            )
+        )
+        data_path = os.path.join(DIR_PATH, "data", "version-5")
+        shutil.copytree(
+            os.path.join(data_path, ENTITY_ID),
+            os.path.join(self.client.raw_backup_dir, ENTITY_ID),
+        )
+        for ext in ("content", "metadata", "pagedata"):
+            shutil.copy2(
+                os.path.join(data_path, f"{ENTITY_ID}.{ext}"),
+                self.client.raw_backup_dir,
+            )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def update_metadata(self, **kwargs):
+        meta_fp = os.path.join(self.client.raw_backup_dir, f"{ENTITY_ID}.metadata")
+        with open(meta_fp, "r") as fh:
+            meta = json.load(fh)
+        meta.update(kwargs)
+        with open(meta_fp, "w") as fh:
+            json.dump(meta, fh)
+
+    def job(self, index):
+        return self.client._conversion_job(
+            ENTITY_ID, self.client._derive_metadata(), index
+        )
+
+    def test_rename_moves_output(self):
+        with self.client._backup_index() as index:
+            job = self.job(index)
+            self.assertEqual(job[-1], os.path.join("My files", "Sample Pens.pdf"))
+
+            # stand in for the rendered document
+            writer = PdfWriter()
+            writer.add_blank_page(100, 100)
+            with open(job[2], "wb") as fh:
+                writer.write(fh)
+            self.client._track_rendered(index, job)
+            self.assertIsNone(self.job(index))
+
+            # renames only change the metadata, the output is moved
+            self.update_metadata(visibleName="Renamed", lastModified="9615242059597")
+            self.assertIsNone(self.job(index))
+            renamed_fp = os.path.join(self.client.pdf_backup_dir, "Renamed.pdf")
+            self.assertTrue(os.path.isfile(renamed_fp))
+            self.assertFalse(os.path.isfile(job[2]))
+            self.assertEqual(self.client.stats["moved"], 1)
+
+            # page edits change the fingerprint
+            rm_fp = os.path.join(
+                self.client.raw_backup_dir,
+                ENTITY_ID,
+                "7fb6da1a-2826-4ff2-93eb-0e38a76f91bb.rm",
+            )
+            os.utime(rm_fp, (0, 0))
+            self.assertIsNotNone(self.job(index))
+
+    def test_clean_stale_outputs(self):
+        with self.client._backup_index() as index:
+            job = self.job(index)
+            with open(job[2], "wb") as fh:
+                fh.write(b"%PDF-1.4\n")
+            self.client._track_rendered(index, job)
+
+            self.client._clean_stale_outputs(index, "pdf", {})
+            self.assertFalse(os.path.isfile(job[2]))
+            self.assertEqual(index.tracked_outputs("pdf"), [])
+
+    def test_clean_outputs_deleted_on_tablet(self):
+        metadata = self.client._derive_metadata()
+        with self.client._backup_index() as index:
+            job = self.job(index)
+            with open(job[2], "wb") as fh:
+                fh.write(b"%PDF-1.4\n")
+            self.client._track_rendered(index, job)
+
+            self.client._clean_stale_outputs(index, "pdf", metadata, {ENTITY_ID})
+            self.assertTrue(os.path.isfile(job[2]))
+
+            self.client._clean_stale_outputs(index, "pdf", metadata, set())
+            self.assertFalse(os.path.isfile(job[2]))
+            self.assertEqual(index.tracked_outputs("pdf"), [])
+
+        # the raw backup is kept, but not rendered again
+        self.client.remote_entity_ids = {"fb2ec1da-8dc3-4a59-a8b4-de1c1b4d27e2"}
+        self.client.convert_xochitl_files()
+        self.assertTrue(
+            os.path.isdir(os.path.join(self.client.raw_backup_dir, ENTITY_ID))
+        )
+        self.assertFalse(os.path.isfile(job[2]))
+
+    def test_update_index_builds_once(self):
+        index_entities = self.client._index_entities
+        with mock.patch.object(
+            self.client, "_index_entities", side_effect=index_entities
+        ) as mock_entities:
+            self.client.update_index()
+        self.assertEqual(mock_entities.call_count, 1)
+        with self.client._backup_index() as index:
+            self.assertEqual(index.lookup(ENTITY_ID)["name"], "Sample Pens")
+
+    def test_index_skips_deleted(self):
+        self.client.update_index()
+        with self.client._backup_index() as index:
+            self.assertIsNotNone(index.lookup(ENTITY_ID))
+
+        # removed from the tablet, the raw backup is kept
+        self.client.remote_entity_ids = {"fb2ec1da-8dc3-4a59-a8b4-de1c1b4d27e2"}
+        self.client.update_index()
+        with self.client._backup_index() as index:
+            self.assertIsNone(index.lookup(ENTITY_ID))
+
+        self.client.remote_entity_ids = None
+        self.update_metadata(deleted=True)
+        self.client.update_index()
+        with self.client._backup_index() as index:
+            self.assertIsNone(index.lookup(ENTITY_ID))
+
+    def test_untracked_output_not_adopted(self):
+        with self.client._backup_index() as index:
+            job = self.job(index)
+            # a leftover output, newer than the entity
+            with open(job[2], "wb") as fh:
+                fh.write(b"%PDF-1.4\n")
+            self.assertIsNone(self.job(index))
+            self.assertIsNone(index.tracked_output(ENTITY_ID, "pdf"))
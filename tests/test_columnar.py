@@ -0,0 +1,64 @@
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+from remarkable_cli.columnar import POINT_FIELDS, export_columnar, np
+from remarkable_cli.convert_rm import ConvertRM
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestColumnar(unittest.TestCase):
+    def test_export_columnar(self):
+        converter = ConvertRM(
+            os.path.join(
+                DIR_PATH, "data", "version-5", "07a07495-09b1-47f9-bb88-370aadc4395b"
+            ),
+            os.path.join(DIR_PATH, "data", "templates"),
+        )
+        with TemporaryDirectory() as tmp_dir:
+            output_dir = os.path.join(tmp_dir, "columnar")
+            export_columnar(converter, output_dir)
+            # exporting again replaces the previous export
+            export_columnar(converter, output_dir)
+            self.assertEqual(os.listdir(tmp_dir), ["columnar"])
+            columns = {
+                os.path.splitext(name)[0]: np.load(
+                    os.path.join(output_dir, name), mmap_mode="r"
+                )
+                for name in os.listdir(output_dir)
+            }
+            self.assertIsInstance(columns["x"], np.memmap)
+            self.assertIsInstance(columns["stroke_offsets"], np.memmap)
+            self._check_columns(converter, columns)
+            # release the maps before the directory is removed
+            del columns
+
+    def _check_columns(self, converter, columns):
+        self.assertEqual(columns["document"], "07a07495-09b1-47f9-bb88-370aadc4395b")
+        self.assertEqual(list(columns["page_ids"]), converter.page_ids)
+
+        # compare against the tuple based decoder, stroke by stroke
+        stroke_id = 0
+        offsets = columns["stroke_offsets"]
+        for page_idx, page_id in enumerate(converter.page_ids):
+            pg_rm_fp = os.path.join(converter.pages_fp, f"{page_id}{os.extsep}rm")
+            with open(pg_rm_fp, "rb") as fh:
+                layers = ConvertRM.read_lines(fh)
+            for layer_idx, strokes in enumerate(layers):
+                for stroke_data, segments in strokes:
+                    self.assertEqual(columns["stroke_page"][stroke_id], page_idx)
+                    self.assertEqual(columns["stroke_layer"][stroke_id], layer_idx)
+                    self.assertEqual(columns["stroke_pen"][stroke_id], stroke_data[0])
+                    start, end = offsets[stroke_id], offsets[stroke_id + 1]
+                    self.assertEqual(end - start, len(segments))
+                    self.assertTrue((columns["stroke"][start:end] == stroke_id).all())
+                    self.assertTrue((columns["page"][start:end] == page_idx).all())
+                    points = np.stack([columns[f][start:end] for f in POINT_FIELDS])
+                    np.testing.assert_array_equal(
+                        points.T, np.array(segments, dtype=np.float32).reshape(-1, 6)
+                    )
+                    stroke_id += 1
+        self.assertEqual(stroke_id, len(columns["stroke_pen"]))
+        self.assertEqual(offsets[-1], len(columns["x"]))
@@ -1,6 +1,12 @@
 import logging
 import os
+import shutil
 import unittest
+from concurrent.futures import ProcessPoolExecutor
+from tempfile import TemporaryDirectory
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import RectangleObject
 
 from remarkable_cli.convert_rm import ConvertRM
 
@@ -43,3 +49,97 @@ class TestConvertRM(unittest.TestCase):
         )
         self.converter.convert_document(pdf_output_path)
         self.assertTrue(True)
+
+    def test_convert_document_parallel(self):
+        with TemporaryDirectory() as tmp_dir:
+            pdf_output_path = os.path.join(tmp_dir, "output.pdf")
+            with ProcessPoolExecutor(max_workers=2) as executor:
+                self.converter.convert_document(pdf_output_path, executor=executor)
+
+            output = PdfReader(pdf_output_path)
+            self.assertEqual(len(output.pages), len(self.converter.page_ids))
+            self.assertEqual(output.metadata.title, "Sample Pens.pdf")
+            self.assertEqual(output.metadata.subject, "Sample Pens")
+            # pages are merged in order, matching the serially rendered pages
+            last_page = PdfReader(self.converter._render_page(3, False)).pages[0]
+            self.assertEqual(
+                output.pages[3].get_contents().get_data(),
+                last_page.get_contents().get_data(),
+            )
+
+    def test_convert_annotated_pdf(self):
+        entity_name = "07a07495-09b1-47f9-bb88-370aadc4395b"
+        data_path = os.path.join(DIR_PATH, "data", "version-5")
+        with TemporaryDirectory() as tmp_dir:
+            entity_path = os.path.join(tmp_dir, entity_name)
+            shutil.copytree(os.path.join(data_path, entity_name), entity_path)
+            for ext in ("content", "metadata", "pagedata"):
+                shutil.copy(f"{os.path.join(data_path, entity_name)}.{ext}", tmp_dir)
+            shutil.copy(
+                os.path.join(data_path, "Sample Pens.pdf"), f"{entity_path}.pdf"
+            )
+
+            converter = ConvertRM(
+                entity_path, os.path.join(DIR_PATH, "data", "templates")
+            )
+            pdf_output_path = os.path.join(tmp_dir, "output.pdf")
+            converter.convert_document(pdf_output_path)
+
+            original = PdfReader(f"{entity_path}.pdf")
+            output = PdfReader(pdf_output_path)
+            self.assertEqual(len(output.pages), len(original.pages))
+            self.assertEqual(output.pages[0].mediabox, original.pages[0].mediabox)
+            self.assertEqual(output.metadata.title, "Sample Pens.pdf")
+
+    def test_overlay_transformation(self):
+        writer = PdfWriter()
+        page = writer.add_blank_page(612, 792)
+        page.cropbox = RectangleObject((100, 100, 400, 500))
+        top_left, bottom_right = (0, ConvertRM.Y_SIZE), (ConvertRM.X_SIZE, 0)
+
+        def assert_maps(transformation, point, expected):
+            for value, expected_value in zip(transformation.apply_on(point), expected):
+                self.assertAlmostEqual(value, expected_value, places=3)
+
+        # the cropbox fills the screen, the screen top left is its top left
+        transformation = ConvertRM._overlay_transformation(page)
+        assert_maps(transformation, top_left, (100, 500))
+        assert_maps(transformation, bottom_right, (400, 100))
+
+        # displayed turned clockwise, the top left is the cropbox bottom left
+        page.rotate(90)
+        transformation = ConvertRM._overlay_transformation(page)
+        assert_maps(transformation, top_left, (100, 100))
+        # the 400 wide displayed page fits the screen width, its top right is the
+        # cropbox top left
+        assert_maps(transformation, (ConvertRM.X_SIZE, ConvertRM.Y_SIZE), (100, 500))
+
+        # landscape, the tablet top edge is on the left of the displayed page
+        page.rotate(-90)
+        page.cropbox = RectangleObject((0, 0, 936, 702))
+        transformation = ConvertRM._overlay_transformation(page, landscape=True)
+        assert_maps(transformation, top_left, (0, 0))
+        assert_maps(transformation, bottom_right, (936, 702))
+
+    def test_failed_render_keeps_output(self):
+        entity_name = "07a07495-09b1-47f9-bb88-370aadc4395b"
+        data_path = os.path.join(DIR_PATH, "data", "version-5")
+        with TemporaryDirectory() as tmp_dir:
+            entity_path = os.path.join(tmp_dir, entity_name)
+            shutil.copytree(os.path.join(data_path, entity_name), entity_path)
+            for ext in ("content", "metadata", "pagedata"):
+                shutil.copy(f"{os.path.join(data_path, entity_name)}.{ext}", tmp_dir)
+            converter = ConvertRM(
+                entity_path, os.path.join(DIR_PATH, "data", "templates")
+            )
+            pg_rm_fp = converter._page_rm_fp(converter.page_ids[2])
+            with open(pg_rm_fp, "r+b") as fh:
+                fh.truncate(os.path.getsize(pg_rm_fp) // 2)
+
+            pdf_output_path = os.path.join(tmp_dir, "output.pdf")
+            with open(pdf_output_path, "wb") as fh:
+                fh.write(b"previous")
+            self.assertRaises(Exception, converter.convert_document, pdf_output_path)
+            with open(pdf_output_path, "rb") as fh:
+                self.assertEqual(fh.read(), b"previous")
+            self.assertEqual(os.listdir(tmp_dir).count("output.pdf.part"), 0)
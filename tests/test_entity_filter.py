@@ -0,0 +1,43 @@
+import unittest
+
+from remarkable_cli.entity_filter import EntityFilter
+
+
+class TestEntityFilter(unittest.TestCase):
+    def setUp(self):
+        self.meta_id = "07a07495-09b1-47f9-bb88-370aadc4395b"
+        self.meta = {"type": "DocumentType", "visibleName": "Sample Pens"}
+        self.path = "Work/Project/Sample Pens"
+        self.content = {"fileType": "notebook"}
+
+    def matches(self, include=(), exclude=()):
+        entity_filter = EntityFilter(include, exclude)
+        return entity_filter.matches(self.meta_id, self.meta, self.path, self.content)
+
+    def test_inactive(self):
+        self.assertFalse(EntityFilter().active)
+        self.assertTrue(self.matches())
+
+    def test_path(self):
+        self.assertTrue(self.matches(include=["Work"]))
+        self.assertTrue(self.matches(include=["path:Work/Proj*"]))
+        self.assertFalse(self.matches(include=["Personal"]))
+        self.assertFalse(self.matches(include=["Work"], exclude=["Work/Project"]))
+
+    def test_fields(self):
+        self.assertTrue(self.matches(include=["name:Sample*"]))
+        self.assertTrue(self.matches(include=[f"uuid:{self.meta_id}"]))
+        self.assertFalse(self.matches(include=["uuid:00000000-*"]))
+        self.assertTrue(self.matches(include=["type:notebook"]))
+        self.assertFalse(self.matches(exclude=["type:notebook"]))
+        self.assertTrue(EntityFilter(["type:pdf"]).needs_content)
+        self.assertFalse(EntityFilter(["name:pdf"]).needs_content)
+
+    def test_entity_type(self):
+        self.assertEqual(EntityFilter.entity_type({"type": "CollectionType"}), "folder")
+        self.assertEqual(
+            EntityFilter.entity_type(self.meta, {"fileType": ""}), "notebook"
+        )
+        self.assertEqual(
+            EntityFilter.entity_type(self.meta, {"fileType": "pdf"}), "pdf"
+        )
@@ -0,0 +1,69 @@
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+from remarkable_cli import build_parser
+from remarkable_cli.fleet import Fleet
+
+CONFIG = """
+[DEFAULT]
+username = root
+password = secret
+
+[tablet-1]
+destination = 192.168.1.20
+include =
+    Work
+    type:notebook
+
+[tablet-2]
+destination = 192.168.1.21
+port = 2222
+pipeline = yes
+backup-dir = /tmp/tablet-2
+log-level = 4
+format = columnar
+"""
+
+
+class TestFleet(unittest.TestCase):
+    def setUp(self):
+        self.parser = build_parser()
+        self.defaults = self.parser.parse_args(
+            ["-b", "/tmp/reMarkable", "--devices", "devices.ini", "-a", "pull"]
+        )
+
+    def load(self, config):
+        with TemporaryDirectory() as tmp_dir:
+            config_fp = os.path.join(tmp_dir, "devices.ini")
+            with open(config_fp, "w") as fh:
+                fh.write(config)
+            return Fleet.load_devices(config_fp, self.defaults, self.parser)
+
+    def test_load_devices(self):
+        devices = self.load(CONFIG)
+        self.assertEqual(list(devices.keys()), ["tablet-1", "tablet-2"])
+
+        tablet_1 = devices["tablet-1"]
+        self.assertEqual(tablet_1.destination, "192.168.1.20")
+        self.assertEqual(tablet_1.password, "secret")
+        self.assertEqual(tablet_1.include, ["Work", "type:notebook"])
+        self.assertEqual(tablet_1.backup_dir, "/tmp/reMarkable/tablet-1")
+        self.assertIsNone(tablet_1.devices)
+
+        tablet_2 = devices["tablet-2"]
+        self.assertEqual(tablet_2.port, 2222)
+        self.assertTrue(tablet_2.pipeline)
+        self.assertEqual(tablet_2.backup_dir, "/tmp/tablet-2")
+        self.assertEqual(tablet_2.log_level, 4)
+        self.assertEqual(tablet_2.format, "columnar")
+        self.assertEqual(tablet_2.action, ["pull"])
+
+    def test_unknown_option(self):
+        self.assertRaises(ValueError, self.load, "[tablet]\ncolour = grey\n")
+        self.assertRaises(ValueError, self.load, "[tablet]\nformat = svg\n")
+        self.assertRaises(ValueError, self.load, "[tablet]\nport = twenty\n")
+
+    def test_fleet_option(self):
+        self.assertRaises(ValueError, self.load, "[tablet]\njobs = 4\n")
+        self.assertRaises(ValueError, self.load, "[DEFAULT]\nmax-transfers = 2\n[a]\n")
@@ -0,0 +1,30 @@
+import unittest
+
+from remarkable_cli.geometry import stroke_outline
+
+
+class TestStrokeOutline(unittest.TestCase):
+    def test_variable_width(self):
+        points = [(0.0, 0.0), (10.0, 0.0), (10.0, 0.0), (20.0, 0.0)]
+        widths = [2.0, 4.0, 6.0, 8.0]
+        outline = stroke_outline(points, widths, stroke_cap="round", cap_segments=4)
+
+        # 3 distinct points on each side, 3 points for each cap
+        self.assertEqual(len(outline), 2 * 3 + 2 * 3)
+        self.assertEqual(outline[0], (0.0, 1.0))
+        # the repeated point keeps the widest width
+        self.assertEqual(outline[1], (10.0, 3.0))
+        self.assertEqual(outline[2], (20.0, 4.0))
+        self.assertAlmostEqual(outline[4][0], 24.0)
+        self.assertEqual(outline[6], (20.0, -4.0))
+        self.assertEqual(outline[8], (0.0, -1.0))
+
+    def test_butt_cap(self):
+        outline = stroke_outline([(0.0, 0.0), (0.0, 5.0)], [2.0, 2.0], "butt")
+        self.assertEqual(outline, [(-1.0, 0.0), (-1.0, 5.0), (1.0, 5.0), (1.0, 0.0)])
+
+    def test_dot(self):
+        outline = stroke_outline([(1.0, 1.0), (1.0, 1.0)], [2.0, 2.0], cap_segments=2)
+        self.assertEqual(len(outline), 4)
+        self.assertEqual(outline[0], (2.0, 1.0))
+        self.assertEqual(stroke_outline([], []), [])
@@ -0,0 +1,26 @@
+import os
+import unittest
+from io import BytesIO
+
+from pypdf import PdfReader
+
+from remarkable_cli.pdf_stream import PDFStreamWriter
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+
+
+class TestPDFStreamWriter(unittest.TestCase):
+    def test_concatenate(self):
+        source_fp = os.path.join(DIR_PATH, "data", "version-5", "Sample Pens.pdf")
+        output = BytesIO()
+        writer = PDFStreamWriter(output)
+        writer.add_pages(PdfReader(source_fp))
+        writer.add_pages(PdfReader(source_fp))
+        writer.close(info={"/Title": "Sample Pens.pdf"})
+
+        output.seek(0)
+        source = PdfReader(source_fp)
+        reader = PdfReader(output, strict=True)
+        self.assertEqual(len(reader.pages), 2 * len(source.pages))
+        self.assertEqual(reader.pages[-1].mediabox, source.pages[-1].mediabox)
+        self.assertEqual(reader.metadata.title, "Sample Pens.pdf")
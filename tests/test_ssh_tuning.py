@@ -0,0 +1,106 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from argparse import Namespace
+from unittest import mock
+
+from remarkable_cli.client import Client
+from remarkable_cli.ssh_tuning import TuningCache, parse_ciphers, supported_ciphers
+
+
+class TestSSHTuning(unittest.TestCase):
+    def test_parse_ciphers(self):
+        self.assertIsNone(parse_ciphers(None))
+        self.assertIsNone(parse_ciphers(" , "))
+        self.assertEqual(
+            parse_ciphers("aes128-ctr, aes256-ctr"), ["aes128-ctr", "aes256-ctr"]
+        )
+        self.assertIn("aes128-ctr", supported_ciphers())
+
+    def test_tuning_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_fp = os.path.join(tmp_dir, "remarkable-cli", "transport.json")
+            cache = TuningCache(cache_fp)
+            self.assertIsNone(cache.get("root@10.11.99.1:22"))
+
+            settings = {"compress": True, "ciphers": ["aes128-ctr"]}
+            cache.put("root@10.11.99.1:22", settings)
+            cache.put("root@192.168.1.20:22", {"compress": False, "ciphers": None})
+            self.assertEqual(TuningCache(cache_fp).get("root@10.11.99.1:22"), settings)
+
+            # expired entries are probed again
+            with open(cache_fp, "r") as fh:
+                entries = json.load(fh)
+            entries["root@10.11.99.1:22"]["tuned"] = (
+                time.time() - 2 * TuningCache.MAX_AGE
+            )
+            with open(cache_fp, "w") as fh:
+                json.dump(entries, fh)
+            self.assertIsNone(cache.get("root@10.11.99.1:22"))
+            self.assertIsNotNone(cache.get("root@192.168.1.20:22"))
+
+    def tuning_client(self, tmp_dir):
+        return Client(
+            Namespace(
+                log_level=0,
+                backup_dir=tmp_dir,
+                include=None,
+                exclude=None,
+                username="root",
+                destination="10.11.99.1",
+                port=22,
+                compress=False,
+                ciphers=None,
+            )
+        )
+
+    def test_auto_tune_skips_failed_probes(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            client = self.tuning_client(tmp_dir)
+            # combinations without a timing fail during the probe transfer
+            timings = {
+                (False, "aes128-ctr"): 2.0,
+                (True, "aes128-ctr"): 1.5,
+                (False, "aes256-ctr"): 1.0,
+            }
+
+            def probe_transfer(ssh_client, probe_files):
+                options = ssh_client.options
+                if options is None:
+                    raise EOFError("channel closed")
+                elapsed = timings[(options["compress"], options["ciphers"][0])]
+                # larger windows are faster, packet sizes make no difference
+                return elapsed - options.get("window_size", 0) / (1 << 24)
+
+            def connect_ssh(**options):
+                if options.get("ciphers") and (
+                    (options["compress"], options["ciphers"][0]) not in timings
+                ):
+                    return mock.Mock(options=None)
+                return mock.Mock(options=options)
+
+            client._connect_ssh = connect_ssh
+            client._probe_files = mock.Mock(return_value=["xochitl/a.rm"])
+            client._probe_transfer = probe_transfer
+            with mock.patch.dict(os.environ, {"XDG_CACHE_HOME": tmp_dir}):
+                settings = client._auto_tune()
+            self.assertEqual(
+                settings,
+                {
+                    "compress": False,
+                    "ciphers": ["aes256-ctr"],
+                    "window_size": 1 << 23,
+                    "max_packet_size": 1 << 15,
+                },
+            )
+
+    def test_auto_tune_without_probe_files(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            client = self.tuning_client(tmp_dir)
+            client._connect_ssh = mock.Mock()
+            client._probe_files = mock.Mock(return_value=[])
+            with mock.patch.dict(os.environ, {"XDG_CACHE_HOME": tmp_dir}):
+                self.assertIsNone(client._auto_tune())
+                self.assertFalse(os.path.exists(TuningCache.default_path()))